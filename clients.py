@@ -0,0 +1,91 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+from config import MTURK_ENVIRONMENTS, MTURK_PROFILE_NAME, MTURK_REGION_NAME, MTURK_MAX_POOL_CONNECTIONS
+from rate_limit import AdaptiveRateLimiter
+
+# boto3 clients are thread safe (sessions are not), so one client per environment is shared by the whole process
+_mturk_clients = dict()
+_mturk_rate_limiters = dict()  # kept across client resets so that learned rates and stats survive
+_mturk_clients_lock = threading.Lock()
+_mturk_max_pool_connections = MTURK_MAX_POOL_CONNECTIONS
+
+# boto calls block, so the async api runs them on threads. the pool matches the connection pool so no thread waits on a connection.
+# it is shared by every hit batch in the process, which is why each batch is limited to MTURK_MAX_CONCURRENT_CALLS_PER_HIT threads (see Hit.acall)
+_mturk_executor = ThreadPoolExecutor(max_workers=MTURK_MAX_POOL_CONNECTIONS)
+
+
+def get_mturk_environment_name(production):
+    return 'production' if production else 'sandbox'
+
+
+def create_mturk_client(production=False, max_pool_connections=MTURK_MAX_POOL_CONNECTIONS):
+    boto_session = boto3.Session(profile_name=MTURK_PROFILE_NAME)
+    return boto_session.client(
+        service_name=MTURK_PROFILE_NAME,
+        region_name=MTURK_REGION_NAME,
+        endpoint_url=MTURK_ENVIRONMENTS[get_mturk_environment_name(production)]['endpoint'],
+        # throttled calls are retried by the rate limiter, which needs to see them to adapt its rates. it retries connection and server errors too
+        config=Config(max_pool_connections=max_pool_connections, retries={'mode': 'standard', 'max_attempts': 1}),
+    )
+
+
+class RateLimitedClient:
+    """
+    proxies a boto client, routing every api call through a rate limiter
+    """
+    unlimited_attributes = {'can_paginate', 'get_paginator', 'get_waiter', 'close', 'meta', 'exceptions'}
+
+    def __init__(self, client, rate_limiter):
+        self.client = client
+        self.rate_limiter = rate_limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+
+        if name.startswith('_') or name in self.unlimited_attributes or not callable(attribute):
+            return attribute
+
+        return functools.partial(self.rate_limiter.call, name, attribute)
+
+
+def get_mturk_rate_limiter(production=False):
+    environment_name = get_mturk_environment_name(production)
+
+    with _mturk_clients_lock:
+        if environment_name not in _mturk_rate_limiters:
+            _mturk_rate_limiters[environment_name] = AdaptiveRateLimiter()
+
+        return _mturk_rate_limiters[environment_name]
+
+
+def get_mturk_client(production=False):
+    environment_name = get_mturk_environment_name(production)
+    rate_limiter = get_mturk_rate_limiter(production)
+
+    with _mturk_clients_lock:
+        if environment_name not in _mturk_clients:
+            client = create_mturk_client(production, max_pool_connections=_mturk_max_pool_connections)
+            _mturk_clients[environment_name] = RateLimitedClient(client, rate_limiter)
+
+        return _mturk_clients[environment_name]
+
+
+def set_mturk_max_pool_connections(max_pool_connections):
+    # clients are built lazily, so dropping the current ones is enough for the new pool size to take effect
+    global _mturk_max_pool_connections
+
+    with _mturk_clients_lock:
+        _mturk_max_pool_connections = max_pool_connections
+        _mturk_clients.clear()
+
+
+async def acall(func, *args, **kwargs):
+    """runs the blocking func (typically a boto call) on the shared mturk thread pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_mturk_executor, functools.partial(func, *args, **kwargs))
@@ -1,17 +1,31 @@
 import itertools
+import math
 import random
 import uuid
 
 from trueskill import *
-import operator as op
-from functools import reduce
 
 
 def ncr(n, r):
-    r = min(r, n - r)
-    numer = reduce(op.mul, range(n, n - r, -1), 1)
-    denom = reduce(op.mul, range(1, r + 1), 1)
-    return numer / denom
+    # exact for any n, 0 if r > n
+    return math.comb(n, r)
+
+
+def unrank_combination(index, n, r):
+    """the index-th r-combination of range(n), in the order itertools.combinations produces them"""
+    combination = []
+    x = 0
+    for i in range(r):
+        # skip the combinations starting with x at this position until index falls into the ones that do
+        while True:
+            num_with_x = math.comb(n - x - 1, r - i - 1)
+            if index < num_with_x:
+                break
+            index -= num_with_x
+            x += 1
+        combination.append(x)
+        x += 1
+    return tuple(combination)
 
 
 class Contestant:
@@ -56,21 +70,24 @@ class CompetitionFFAWTA:
         return itertools.combinations(self.get_contestant_ids(), self.match_size)
 
     def get_num_possible_matchups(self):
-        return int(ncr(self.num_contestants, self.match_size))
+        return ncr(self.num_contestants, self.match_size)
 
     def get_matchups(self, num_matchups):
-
-        matchups = []
+        """
+        distinct random matchups, only repeating once every possible matchup was used (and then cycling through them anew).
+        matchups are unranked from randomly sampled indices, so nothing scales with the number of possible matchups
+        """
+        contestant_ids = self.get_contestant_ids()
         num_combinations = self.get_num_possible_matchups()
 
-        ideal_matchups = list(self.get_ideal_matchups())
+        if num_matchups > 0 and num_combinations == 0:
+            raise ValueError(f'{self.num_contestants} contestants are too few for matchups of {self.match_size}')
 
-        for n in range(num_matchups):
-            ind = n % num_combinations
-            if ind == 0:
-                random.shuffle(ideal_matchups)
-
-            matchups.append(ideal_matchups[ind])
+        matchups = []
+        while len(matchups) < num_matchups:
+            num_in_cycle = min(num_matchups - len(matchups), num_combinations)
+            for index in random.sample(range(num_combinations), num_in_cycle):
+                matchups.append(tuple(contestant_ids[i] for i in unrank_combination(index, self.num_contestants, self.match_size)))
 
         return matchups
 
@@ -0,0 +1,128 @@
+import copy
+import json
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, zlib is always available
+    zstandard = None
+
+# every encoded property starts with this header, followed by one byte naming the compression algorithm
+ENCODED_PROPERTY_HEADER = b'hmz1'
+ALGORITHM_IDS = {'zlib': b'z', 'zstd': b's'}
+
+
+class PropertyCodec:
+    """
+    stores a property as a compressed json blob and turns such blobs back into the original value.
+    note that json has no datetime type, so datetimes (e.g. in creation_response) are decoded as iso strings
+    """
+
+    def __init__(self, algorithm='zlib', level=6):
+        if algorithm == 'zstd' and zstandard is None:
+            raise RuntimeError('the zstd codec needs the zstandard package')
+        if algorithm not in ALGORITHM_IDS:
+            raise ValueError(f'unknown compression algorithm {algorithm}')
+
+        self.algorithm = algorithm
+        self.level = level
+
+    def compress(self, data):
+        if self.algorithm == 'zstd':
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return zlib.compress(data, self.level)
+
+    def encode(self, value):
+        data = json.dumps(value, separators=(',', ':'), default=lambda o: o.isoformat() if hasattr(o, 'isoformat') else str(o)).encode('utf-8')
+        return ENCODED_PROPERTY_HEADER + ALGORITHM_IDS[self.algorithm] + self.compress(data)
+
+    def decode(self, value):
+        if not is_encoded(value):
+            return value
+
+        algorithm_id = value[len(ENCODED_PROPERTY_HEADER):len(ENCODED_PROPERTY_HEADER) + 1]
+        compressed = value[len(ENCODED_PROPERTY_HEADER) + 1:]
+
+        if algorithm_id == ALGORITHM_IDS['zstd']:
+            data = zstandard.ZstdDecompressor().decompress(compressed)
+        else:
+            data = zlib.decompress(compressed)
+
+        return json.loads(data)
+
+
+def is_encoded(value):
+    return isinstance(value, bytes) and value.startswith(ENCODED_PROPERTY_HEADER)
+
+
+default_codec = PropertyCodec()
+
+
+def encode_entity_properties(entity, properties, codec=default_codec):
+    """encodes the given properties of entity in place and excludes them from indexes (blobs cannot be indexed anyway)"""
+    for k in properties:
+        if k in entity and not is_encoded(entity[k]):
+            entity[k] = codec.encode(entity[k])
+            if hasattr(entity, 'exclude_from_indexes'):
+                entity.exclude_from_indexes.add(k)
+
+    return entity
+
+
+def decode_entity_properties(entity, properties, codec=default_codec):
+    for k in properties:
+        if k in entity:
+            entity[k] = codec.decode(entity[k])
+
+    return entity
+
+
+def get_serialized_size(entity):
+    try:
+        from google.cloud.datastore.helpers import entity_to_protobuf
+        return entity_to_protobuf(entity)._pb.ByteSize()
+    except (ImportError, AttributeError):  # the json size is close enough where the protobuf helpers are unavailable
+        return len(json.dumps(dict(entity), default=str).encode('utf-8'))
+
+
+def benchmark_entities(entities, properties, codec=default_codec):
+    """
+    measures what encoding the given properties saves per entity: serialized bytes (what every read and write transfers)
+    and the time spent encoding and decoding
+    """
+    num_entities = 0
+    raw_bytes = 0
+    encoded_bytes = 0
+    encode_seconds = 0
+    decode_seconds = 0
+
+    for entity in entities:
+        raw_bytes += get_serialized_size(entity)
+
+        encoded_entity = copy.copy(entity)
+        if hasattr(entity, 'exclude_from_indexes'):
+            encoded_entity.exclude_from_indexes = set(entity.exclude_from_indexes)
+
+        start = time.perf_counter()
+        encode_entity_properties(encoded_entity, properties, codec=codec)
+        encode_seconds += time.perf_counter() - start
+
+        encoded_bytes += get_serialized_size(encoded_entity)
+
+        start = time.perf_counter()
+        decode_entity_properties(encoded_entity, properties, codec=codec)
+        decode_seconds += time.perf_counter() - start
+
+        num_entities += 1
+
+    num_entities = max(num_entities, 1)
+
+    return dict(
+        algorithm=codec.algorithm,
+        raw_bytes_per_entity=raw_bytes / num_entities,
+        encoded_bytes_per_entity=encoded_bytes / num_entities,
+        saved_bytes_per_entity=(raw_bytes - encoded_bytes) / num_entities,
+        encode_ms_per_entity=1000 * encode_seconds / num_entities,
+        decode_ms_per_entity=1000 * decode_seconds / num_entities,
+    )
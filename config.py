@@ -1,3 +1,5 @@
+import os
+
 MINUTE = 60
 HOUR = 60 * MINUTE
 
@@ -89,4 +91,73 @@ mandatory_hit_attributes = {
     'Reward',
     'QualificationRequirements',
     # 'MaxAssignments' # given at launch time
-}
\ No newline at end of file
+}
+
+# size of the http connection pool shared by all threads borrowing an mturk client
+MTURK_MAX_POOL_CONNECTIONS = 50
+
+# seconds for which a fetched hit status is shared by completed(), poll(), progress bars and observers before it is fetched again
+HIT_STATUS_CACHE_TTL = 5
+
+# approve / reject calls are made by a pool of this many threads and retried up to this many times
+REVIEW_MAX_WORKERS = 8
+REVIEW_MAX_ATTEMPTS = 3
+
+# requests per second each mturk operation starts at. the limiter raises the rate a little with every successful call, up to
+# MTURK_MAX_RATE_LIMIT, and halves it whenever mturk throttles, so these only need to be safe starting points, not the actual limits
+MTURK_DEFAULT_RATE_LIMIT = 5
+MTURK_OPERATION_RATE_LIMITS = {
+    'create_hit': 5,
+    'get_hit': 10,
+    'list_assignments_for_hit': 10,
+    'approve_assignment': 5,
+    'reject_assignment': 5,
+    'delete_hit': 2,
+    'update_expiration_for_hit': 2,
+}
+MTURK_MAX_RATE_LIMIT = 20
+MTURK_MAX_THROTTLING_RETRIES = 6
+
+# maximum number of entities per datastore get_multi / put_multi / delete_multi call
+DATASTORE_BATCH_LIMIT = 500
+
+# launched hits are written in put_multi calls of this many entities, a launch that raises still writes the rest of its hits
+LAUNCH_SAVE_CHUNK_SIZE = 25
+
+# opt in to storing the large unindexed hit properties as compressed json blobs, reads decode both forms
+COMPRESS_LARGE_HIT_PROPERTIES = False
+
+# number of submissions the orchestrator launches or propagates at once, 1 processes them one after the other
+PIPELINE_MAX_WORKERS = 8
+
+# blocking calls a single hit batch may have on the shared mturk thread pool at once, split so concurrent pipelines cannot starve each other.
+# a launch with an explicit max_workers raises its batch's share to max_workers for the duration of the launch
+MTURK_MAX_CONCURRENT_CALLS_PER_HIT = max(MTURK_MAX_POOL_CONNECTIONS // PIPELINE_MAX_WORKERS, 1)
+
+# bounds and backoff of the per submission check interval, plus the pickup latency assumed for a hit type before any was observed
+SCHEDULER_MIN_CHECK_INTERVAL = 30
+SCHEDULER_MAX_CHECK_INTERVAL = HOUR
+SCHEDULER_BACKOFF_FACTOR = 2
+SCHEDULER_DEFAULT_PICKUP_LATENCY = MINUTE * 5
+SCHEDULER_PICKUP_LATENCY_SMOOTHING = 0.3
+
+# image url verdicts are cached for this many seconds, checks give up after the timeout and run on a shared pool of workers
+IMAGE_VALIDATION_TTL = HOUR
+IMAGE_VALIDATION_TIMEOUT = 10
+IMAGE_VALIDATION_MAX_WORKERS = 16
+
+# candidate thumbnails are downloaded and uploaded on threads and rendered on processes, with at most THUMBNAIL_QUEUE_SIZE waiting between stages
+THUMBNAIL_DOWNLOAD_WORKERS = 8
+THUMBNAIL_RENDER_WORKERS = None  # one process per cpu
+THUMBNAIL_UPLOAD_WORKERS = 8
+THUMBNAIL_QUEUE_SIZE = 4
+
+# downloaded images are kept on disk, content addressed, and the least recently used ones are evicted beyond the size limit.
+# the directory defaults to one next to this file, independent of the working directory, and can be moved with an environment variable
+IMAGE_CACHE_DIRECTORY = os.path.abspath(os.environ.get('IMAGE_CACHE_DIRECTORY', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'image cache')))
+IMAGE_CACHE_MAX_BYTES = 1024 ** 3
+IMAGE_CACHE_MAX_WORKERS = 4
+IMAGE_CACHE_INDEX_SAVE_INTERVAL = 30  # seconds between writes of the index, it is written once more at exit
+
+# number of blob deletes / publishes sent to cloud storage at once
+STORAGE_MAX_WORKERS = 16
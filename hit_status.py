@@ -0,0 +1,49 @@
+from config import HIT_STATUS_CACHE_TTL
+from utils import CoalescingCache
+
+
+def get_num_submitted_assignments(hit):
+    # whatever is neither available nor pending has been submitted (and possibly reviewed already)
+    return hit['MaxAssignments'] - hit['NumberOfAssignmentsAvailable'] - hit['NumberOfAssignmentsPending']
+
+
+class HitStatusCache:
+    """
+    caches get_hit responses per hit id for ttl seconds. concurrent requests for the same hit are coalesced into a single api call
+    """
+
+    def __init__(self, ttl=HIT_STATUS_CACHE_TTL):
+        self.cache = CoalescingCache(ttl=ttl)
+
+    @property
+    def ttl(self):
+        return self.cache.ttl
+
+    @ttl.setter
+    def ttl(self, ttl):
+        self.cache.ttl = ttl
+
+    @property
+    def num_api_calls(self):
+        return self.cache.num_loads
+
+    @property
+    def num_cache_hits(self):
+        return self.cache.num_cache_hits
+
+    def get_hit(self, boto_client, hit_id):
+        return self.cache.get(hit_id, lambda hit_id: boto_client.get_hit(HITId=hit_id)['HIT'])
+
+    def get_num_submitted_assignments(self, boto_client, hit_id):
+        return get_num_submitted_assignments(self.get_hit(boto_client, hit_id))
+
+    def prime(self, hits):
+        """stores hits fetched in bulk (e.g. by list_hits) as if they had been fetched one by one"""
+        for hit in hits:
+            self.cache.put(hit['HITId'], hit)
+
+    def invalidate(self, hit_id=None):
+        self.cache.invalidate(hit_id)
+
+
+hit_status_cache = HitStatusCache()
@@ -1,22 +1,41 @@
+import asyncio
 import collections
 import datetime
 import json
 import os
+import re
 import time
 import uuid
 
-import boto3
 import xmltodict
+from botocore.exceptions import ClientError
 from time import sleep
 from typing import Dict, Tuple, Sequence
 from tqdm import tqdm
 
-from google.cloud import datastore
-
-from config import QUESTION_XML, MTURK_ENVIRONMENTS, MTURK_PROFILE_NAME, DEFAULT_TASK_QUALIFICATIONS, us_high_school_qualification, \
-    MTURK_REGION_NAME, HOUR, mandatory_hit_attributes
+from config import MTURK_ENVIRONMENTS, DEFAULT_TASK_QUALIFICATIONS, us_high_school_qualification, HOUR, mandatory_hit_attributes, \
+    MTURK_MAX_CONCURRENT_CALLS_PER_HIT, MTURK_MAX_POOL_CONNECTIONS, LAUNCH_SAVE_CHUNK_SIZE
 from abc import ABC, abstractmethod
-from utils import filter_non_ascii
+from clients import get_mturk_client, acall
+from reviews import ReviewQueue, pop_failed_review_assignment_ids
+from persistence import new_hit_entity, new_assignment_entity, put_multi, save_launched_instances, DirtyTracker, HIT_PROPERTIES_NOT_STORED, \
+    encode_hit_entity, decode_hit_entities, legacy_assignment_entities
+from hit_status import hit_status_cache, get_num_submitted_assignments
+from templates import template_cache, TEMPLATE_STRIPPED_CHARACTERS_KEY
+from utils import strip_non_ascii_params, run_sync
+
+# hit ids are 30 upper case letters and digits, unlike the uuid4 request tokens
+HIT_ID_PATTERN = re.compile(r'\b[0-9A-Z]{30}\b')
+
+
+def is_duplicate_request_token_error(e):
+    # mturk answers a create_hit whose UniqueRequestToken was used before with a RequestError that names the existing hit
+    if not isinstance(e, ClientError):
+        return False
+
+    error = e.response.get('Error') or dict()
+    return error.get('Code') == 'RequestError' and \
+        ('UniqueRequestToken' in (error.get('Message') or '') or 'HitAlreadyExists' in str(e.response.get('TurkErrorCode')))
 
 
 def extract_free_text(answer_dict):
@@ -45,6 +64,24 @@ class TqdmUpTo(tqdm):
 
 
 AnswerReport = collections.namedtuple('AnswerReport', 'deemed_acceptable requester_feedback')
+HitLaunchFailure = collections.namedtuple('HitLaunchFailure', 'index hit_params request_token exception')
+StrippedHitParams = collections.namedtuple('StrippedHitParams', 'index hit_params stripped_characters')
+
+
+class QuestionRenderReport:
+    def __init__(self):
+        self.num_rendered = 0
+        self.stripped = []  # StrippedHitParams for every hit whose question xml had non ascii characters removed
+
+    def add(self, index, hit_params, stripped_characters):
+        self.num_rendered += 1
+        if len(stripped_characters) > 0:
+            self.stripped.append(StrippedHitParams(index, hit_params, stripped_characters))
+
+    def log(self):
+        print(f'{len(self.stripped)} of {self.num_rendered} question xmls had non ascii characters removed')
+        for stripped_hit_params in self.stripped:
+            print(f'\t{stripped_hit_params.index}: {stripped_hit_params.stripped_characters}')
 
 
 def check_task_attributes_validity(task_attributes):
@@ -120,11 +157,14 @@ class Hit(ABC):
         pass
 
     exclude_additional_properties_from_indexes = False
+    status_cache = hit_status_cache
+    validate_task_attributes = True  # hits that are only polled, never launched, have no task attributes to validate
+    max_concurrent_calls = MTURK_MAX_CONCURRENT_CALLS_PER_HIT
 
-    def __init__(self, hit_attributes, templates_folder='hit templates', production=False):  # @todo: nested pbars per hit
+    def __init__(self, hit_attributes, templates_folder='hit templates', production=False, event_consumer=None):  # @todo: nested pbars per hit
 
         self.exclude_additional_properties_from_indexes = None
-        if production:
+        if production and self.validate_task_attributes:
             check_task_attributes_validity(hit_attributes)
 
         hit_attributes = {  # task attributes are inherent to hits with the same name (classes)
@@ -146,128 +186,293 @@ class Hit(ABC):
 
         self.mturk_environment = MTURK_ENVIRONMENTS["production"] if self.production else MTURK_ENVIRONMENTS["sandbox"]
 
-        self.boto_session = boto3.Session(profile_name=MTURK_PROFILE_NAME)
-        self.boto_client = self.boto_session.client(
-            service_name=MTURK_PROFILE_NAME,
-            region_name=MTURK_REGION_NAME,
-            endpoint_url=self.mturk_environment['endpoint'],
-        )
+        self.boto_client = get_mturk_client(self.production)
+        self.event_consumer = event_consumer  # a notifications.HitEventConsumer, has mturk publish events for every launched hit type
+        self.review_queue = ReviewQueue(self.boto_client)
 
         self.launched_instances = dict()
+        self.dirty_tracker = DirtyTracker(ignored_properties=HIT_PROPERTIES_NOT_STORED)
+        self.unsaved_assignment_results = []  # (hit id, assignment id, parsed result) not yet written as assignment entities
         self.hit_ids = []
 
         self.assignments_launched = None
         self.preview_links = []
 
         self.current_hit_params = None
+        self.launch_failures = []
+
+        self.call_semaphore = None
+        self.call_semaphore_loop = None
+
+    async def acall(self, func, *args, **kwargs):
+        """
+        runs a blocking call on the shared mturk thread pool, with at most max_concurrent_calls in flight for this hit batch,
+        so that concurrently propagated submissions share the pool instead of one of them taking all of its threads
+        """
+        loop = asyncio.get_running_loop()
+        if self.call_semaphore is None or self.call_semaphore_loop is not loop:  # semaphores belong to the loop they are first used on
+            self.call_semaphore = asyncio.Semaphore(self.max_concurrent_calls)
+            self.call_semaphore_loop = loop
+
+        async with self.call_semaphore:
+            return await acall(func, *args, **kwargs)
 
-    def launch_batch(self, hit_paramses: Sequence[Dict], max_assignments=1, datastore_client=None):
+    def set_max_concurrent_calls(self, max_concurrent_calls):
+        # only called while none of this batch's calls are in flight, the next acall creates a semaphore of the new size
+        self.max_concurrent_calls = max_concurrent_calls
+        self.call_semaphore = None
+
+    def launch_batch(self, hit_paramses: Sequence[Dict], max_assignments=1, datastore_client=None, max_workers=None):
+        return run_sync(self.alaunch_batch(hit_paramses, max_assignments=max_assignments, datastore_client=datastore_client, max_workers=max_workers))
+
+    async def alaunch_batch(self, hit_paramses: Sequence[Dict], max_assignments=1, datastore_client=None, max_workers=None):
+        """
+        launches one hit per entry in hit_paramses. if max_workers is given, at most max_workers create_hit calls are in flight at once
+        and failing hits are reported in self.launch_failures instead of aborting the whole batch. for the launch, this batch's share of the
+        mturk thread pool (max_concurrent_calls) is raised to max_workers, the pool itself still caps it at MTURK_MAX_POOL_CONNECTIONS.
+        hit_ids and preview_links keep the order of hit_paramses.
+        """
         self.hit_attributes['MaxAssignments'] = max_assignments
 
+        max_concurrent_calls = self.max_concurrent_calls
+        if max_workers is not None and max_workers >= max_concurrent_calls:
+            if max_workers > MTURK_MAX_POOL_CONNECTIONS:
+                print(f'max_workers={max_workers} exceeds the {MTURK_MAX_POOL_CONNECTIONS} mturk pool threads, '
+                      f'at most {MTURK_MAX_POOL_CONNECTIONS} hits are created at once')
+            self.set_max_concurrent_calls(max_workers + 1)  # one more for registering and saving the launched hits
+
         self.assignments_launched = 0
+        self.launch_failures = []
 
         batch_id = str(uuid.uuid4())
 
-        for hit_params in hit_paramses:  # the extra es suffix denotes a collection of collections
+        # the extra es suffix denotes a collection of collections
+        # request tokens uniquely identify the parameters used to create each hit and are drawn up front so that they survive retries
+        request_tokens = [str(uuid.uuid4()) for _ in hit_paramses]
 
-            self.current_hit_params = hit_params
+        # launched hits are written in chunks as they are registered, so that a crash mid batch leaves no paid hit without an entity
+        unsaved_hit_ids = []
 
-            request_token = str(uuid.uuid4())  # uniquely identifies the parameters used to create this hit
+        async def save_hit_entities(save_all=False):
+            if datastore_client is None or len(unsaved_hit_ids) == 0 or (not save_all and len(unsaved_hit_ids) < LAUNCH_SAVE_CHUNK_SIZE):
+                return
 
-            requester_annotation = json.dumps(dict(
-                request_token=request_token,
-                batch_id=batch_id,
-            ))
+            hit_ids = list(unsaved_hit_ids)
+            del unsaved_hit_ids[:]
 
-            try:  # todo try loop if problem with same UniqueRequestToken=param_id
-                response = self.boto_client.create_hit(
-                    **self.hit_attributes,
-                    Question=self.get_hit_xml(hit_params),
-                    RequesterAnnotation=requester_annotation,
-                    UniqueRequestToken=request_token
-                )
+            hit_entities = [new_hit_entity(datastore_client, self.launched_instances[hit_id]) for hit_id in hit_ids]
+            await self.acall(put_multi, datastore_client, hit_entities)
 
-                assert response['ResponseMetadata']['HTTPStatusCode'] == 200
-                # response['ResponseMetadata']['RetryAttempts']
-            except Exception as e:
-                raise e
-
-            self.assignments_launched += self.hit_attributes['MaxAssignments']
-
-            del response['HIT']['Question']
-
-            hit_id = response['HIT']['HITId']
-            self.hit_ids.append(hit_id)
-
-            hit_type_id = response['HIT']['HITTypeId']
-
-            preview_link = self.mturk_environment['preview'] + "?groupId={}".format(hit_type_id)
-            self.preview_links.append(preview_link)
-
-            properties_to_be_excluded_from_indexes = ['creation_response', 'results']
-
-            if not self.exclude_additional_properties_from_indexes:
-                properties_to_be_excluded_from_indexes.append('additional_properties')
-
-            self.launched_instances[hit_id] = dict(  # work with an entire local version of his + assignments_launhced etc
-                hit_id=hit_id,
-                hit_batch_id=batch_id,
-                hit_name=self.name,
-                request_token=request_token,
-                creation_time=response['HIT']['CreationTime'],
-                active=True,
-                creation_response=response,
-                assignments_launched=max_assignments,
-                assignments_completed=0,
-                assignment_ids_parsed=[],
-                results_ready=False,
-                results=[],
-                status=None,
-                preview_link=preview_link,
-                production=self.production,
-                hit_params=hit_params,
-                additional_properties=self.get_additional_entity_properties()
-            )
+            for hit_id in hit_ids:
+                self.dirty_tracker.mark_clean(self.launched_instances[hit_id])
 
-            if datastore_client is not None:
-                database_entry = datastore.Entity(
-                    datastore_client.key('hit', hit_id),
-                    exclude_from_indexes=('creation_response', 'results')
-                )
+        try:
+            if max_workers is None:
+                for hit_params, request_token in zip(hit_paramses, request_tokens):
+                    response = await self.acall(self.create_hit, hit_params, request_token, batch_id)
+                    await self.acall(self.register_launched_hit, hit_params, request_token, batch_id, response, max_assignments)
+
+                    unsaved_hit_ids.append(response['HIT']['HITId'])
+                    await save_hit_entities()
+            else:
+                semaphore = asyncio.Semaphore(max_workers)
+                register_lock = asyncio.Lock()
+                responses = dict()
+                num_registered = 0
+
+                async def create_hit(i, hit_params, request_token):
+                    nonlocal num_registered
+
+                    async with semaphore:
+                        try:
+                            responses[i] = await self.acall(self.create_hit, hit_params, request_token, batch_id)
+                        except Exception as e:
+                            responses[i] = e
+
+                    # hits are registered as soon as every hit before them is, so hit_ids keep the order of hit_paramses
+                    async with register_lock:
+                        while num_registered in responses:
+                            j = num_registered
+                            response = responses.pop(j)
+                            num_registered += 1
+
+                            if isinstance(response, Exception):
+                                self.launch_failures.append(HitLaunchFailure(j, hit_paramses[j], request_tokens[j], response))
+                                continue
+
+                            await self.acall(self.register_launched_hit, hit_paramses[j], request_tokens[j], batch_id, response, max_assignments)
+                            unsaved_hit_ids.append(response['HIT']['HITId'])
 
-                del response['HIT']['Question']
+                        await save_hit_entities()
 
-                database_entry.update(self.launched_instances[hit_id])
-                datastore_client.put(database_entry)
+                await asyncio.gather(*[create_hit(i, hit_params, request_token) for i, (hit_params, request_token) in
+                                       enumerate(zip(hit_paramses, request_tokens))])
+
+                if len(self.launch_failures) > 0:
+                    print(f'{len(self.launch_failures)} of {len(hit_paramses)} hits could not be launched')
+        finally:
+            await save_hit_entities(save_all=True)
+            self.set_max_concurrent_calls(max_concurrent_calls)
 
         if not self.production:
             print("You can view the HITs here:")
             print(self.preview_links)
             print(self.hit_ids)
 
-        self.update_results()
+        await self.aupdate_results()
+
+        return self.launch_failures
+
+    def create_hit(self, hit_params, request_token, batch_id):
+        requester_annotation = json.dumps(dict(
+            request_token=request_token,
+            batch_id=batch_id,
+        ))
+
+        # throttled, timed out and failed calls are retried by the client's rate limiter, reusing the same UniqueRequestToken
+        try:
+            response = self.boto_client.create_hit(
+                **self.hit_attributes,
+                Question=self.get_hit_xml(hit_params),
+                RequesterAnnotation=requester_annotation,
+                UniqueRequestToken=request_token
+            )
+        except ClientError as e:
+            if not is_duplicate_request_token_error(e):
+                raise
+
+            # an earlier attempt reached mturk even though its response was lost, so the hit exists and is launched
+            response = self.get_hit_by_request_token(request_token, e)
+
+        assert response['ResponseMetadata']['HTTPStatusCode'] == 200
+        # response['ResponseMetadata']['RetryAttempts']
+
+        del response['HIT']['Question']
+
+        return response
+
+    def get_hit_by_request_token(self, request_token, duplicate_request_token_error):
+        match = HIT_ID_PATTERN.search((duplicate_request_token_error.response.get('Error') or dict()).get('Message') or '')
+        if match is not None:
+            return self.boto_client.get_hit(HITId=match.group(0))
+
+        # the error did not name the hit, so it is found by the request token stored in its annotation
+        list_hits_response = self.boto_client.list_hits(MaxResults=100)
+        while True:
+            for hit in list_hits_response['HITs']:
+                try:
+                    annotation = json.loads(hit.get('RequesterAnnotation') or '{}')
+                except ValueError:
+                    continue
+                if isinstance(annotation, dict) and annotation.get('request_token') == request_token:
+                    return self.boto_client.get_hit(HITId=hit['HITId'])
+
+            if 'NextToken' not in list_hits_response:
+                raise duplicate_request_token_error
+            list_hits_response = self.boto_client.list_hits(MaxResults=100, NextToken=list_hits_response['NextToken'])
+
+    def register_launched_hit(self, hit_params, request_token, batch_id, response, max_assignments):
+        self.current_hit_params = hit_params
+
+        self.assignments_launched += max_assignments
+
+        hit_id = response['HIT']['HITId']
+        self.hit_ids.append(hit_id)
+
+        hit_type_id = response['HIT']['HITTypeId']
+
+        if self.event_consumer is not None:
+            self.event_consumer.register_hit_type(self.boto_client, hit_type_id)
+
+        preview_link = self.mturk_environment['preview'] + "?groupId={}".format(hit_type_id)
+        self.preview_links.append(preview_link)
+
+        properties_to_be_excluded_from_indexes = ['creation_response', 'results']
+
+        if not self.exclude_additional_properties_from_indexes:
+            properties_to_be_excluded_from_indexes.append('additional_properties')
+
+        self.launched_instances[hit_id] = dict(  # work with an entire local version of his + assignments_launhced etc
+            hit_id=hit_id,
+            hit_batch_id=batch_id,
+            hit_name=self.name,
+            request_token=request_token,
+            creation_time=response['HIT']['CreationTime'],
+            active=True,
+            creation_response=response,
+            assignments_launched=max_assignments,
+            assignments_completed=0,
+            assignment_ids_parsed=[],
+            failed_review_assignment_ids=[],
+            first_submission_time=None,
+            results_ready=False,
+            results=[],
+            status=None,
+            preview_link=preview_link,
+            production=self.production,
+            hit_params=hit_params,
+            additional_properties=self.get_additional_entity_properties()
+        )
 
     def get_hit_xml(self, params):
-        html_layout = open(self.template_location, 'r').read()
-        hit_question_xml = QUESTION_XML.format(html_layout)
-        for k, v in params.items():  # todo: handle with jninja (see WordEmphasisHitBatch)
-            hit_question_xml = hit_question_xml.replace(f'${{{k}}}', v)
+        hit_question_xml, stripped_characters = self.render_hit_xml(params)
 
-        filtered_hit_question_xml = filter_non_ascii(hit_question_xml)
-        if filtered_hit_question_xml != hit_question_xml:
+        if len(stripped_characters) > 0:
             raise RuntimeWarning('some non ascii characters were removed from question xml')
 
-        return filtered_hit_question_xml
+        return hit_question_xml
+
+    def render_hit_xml(self, params):
+        """returns the ascii only question xml for params, along with the non ascii characters that were stripped by param name"""
+        params, stripped_characters = strip_non_ascii_params(params)
+
+        compiled_template = template_cache.get(self.template_location)  # todo: handle with jninja (see WordEmphasisHitBatch)
+        if compiled_template.stripped_characters:
+            stripped_characters[TEMPLATE_STRIPPED_CHARACTERS_KEY] = compiled_template.stripped_characters
+
+        return compiled_template.render(params), stripped_characters
+
+    def render_hit_xmls(self, hit_paramses):
+        """
+        lazily renders the question xml for every entry in hit_paramses. returns a generator of ready to send question xmls and a
+        QuestionRenderReport that is filled in as the generator is consumed
+        """
+        report = QuestionRenderReport()
+
+        def generate():
+            for i, hit_params in enumerate(hit_paramses):
+                hit_question_xml, stripped_characters = self.render_hit_xml(hit_params)
+                report.add(i, hit_params, stripped_characters)
+                yield hit_question_xml
+
+        return generate(), report
 
     def parse_answers(self, answer_dict):
         return answer_dict
 
     def get_assignments_by_hit_id(self, hit_id):
+        return run_sync(self.aget_assignments_by_hit_id(hit_id))
+
+    async def aget_assignments_by_hit_id(self, hit_id):
+
+        await self.acall(self.get_num_submitted_assignments, hit_id)  # Get a list of the Assignments that have been submitted
 
-        hit = self.boto_client.get_hit(HITId=hit_id)
+        return await self.acall(self.list_assignments_by_hit_id, hit_id)
 
-        self.launched_instances[hit_id]['status'] = hit['HIT']['HITStatus']  # Get a list of the Assignments that have been submitted
+    async def aget_assignments_by_hit_ids(self, hit_ids):
+        """pages through the assignments of all hit_ids concurrently, returns a list of assignments per hit id"""
+        assignmentses = await asyncio.gather(*[self.aget_assignments_by_hit_id(hit_id) for hit_id in hit_ids])
+        return dict(zip(hit_ids, assignmentses))
 
+    def get_num_submitted_assignments(self, hit_id):
+        hit = self.status_cache.get_hit(self.boto_client, hit_id)
+
+        if hit_id in self.launched_instances:
+            self.launched_instances[hit_id]['status'] = hit['HITStatus']
+
+        return get_num_submitted_assignments(hit)
+
+    def list_assignments_by_hit_id(self, hit_id):
         assignments = []
 
         list_assignments_response = self.boto_client.list_assignments_for_hit(
@@ -288,87 +493,171 @@ class Hit(ABC):
 
         return assignments
 
-    def update_results(self, datastore_client=None):
+    def get_outstanding_hit_ids(self):
+        # hits with failed reviews are polled again even when all their assignments are in, to retry the reviews
+        return [hit_id for hit_id, launched_instance in self.launched_instances.items() if
+                not launched_instance.get('ready', False) or len(launched_instance.get('failed_review_assignment_ids', [])) > 0]
 
-        for hit_id in self.launched_instances.keys():
-            assignments = self.get_assignments_by_hit_id(hit_id)
+    def collect_review_failures(self):
+        """
+        records the reviews of this batch's hits that failed since the last poll on their launched instances, so they are stored and retried,
+        and clears the ones a retry has reviewed since. returns the ids of the hits whose record changed
+        """
+        reviewed_assignment_ids = self.review_queue.pop_reviewed_assignment_ids()
+        changed_hit_ids = []
 
-            assignments_completed = len(assignments)
-            self.launched_instances[hit_id]['assignments_completed'] = assignments_completed
-            self.launched_instances[hit_id]['ready'] = assignments_completed == self.launched_instances[hit_id]['assignments_launched']
+        for hit_id, launched_instance in self.launched_instances.items():
+            failed_review_assignment_ids = launched_instance.setdefault('failed_review_assignment_ids', [])
+            previous_failed_review_assignment_ids = list(failed_review_assignment_ids)
 
-            parsed_results = []
-            for assignment in assignments:
+            for assignment_id in pop_failed_review_assignment_ids(hit_id):
+                if assignment_id not in failed_review_assignment_ids:
+                    failed_review_assignment_ids.append(assignment_id)
 
-                # Retrieve the attributes for each Assignment
-                assignment_id = assignment['AssignmentId']
+            failed_review_assignment_ids[:] = [assignment_id for assignment_id in failed_review_assignment_ids if assignment_id not in reviewed_assignment_ids]
 
-                if assignment_id in self.launched_instances[hit_id]['assignment_ids_parsed']:
-                    continue
+            if failed_review_assignment_ids != previous_failed_review_assignment_ids:
+                changed_hit_ids.append(hit_id)
+
+        return changed_hit_ids
 
-                # Retrieve the value submitted by the Worker from the XML
-                answer_dict = xmltodict.parse(assignment['Answer'])
-                parsed_result = self.parse_answers(answer_dict)
-                parsed_result['worker_id'] = assignment['WorkerId']
-                parsed_result['submission_time'] = assignment['SubmitTime']
-                parsed_results.append(parsed_result)
-
-                # Approve the Assignment (if it hasn't been already)
-                if assignment['AssignmentStatus'] == 'Submitted':
-                    answer_report = self.acceptable_answer(parsed_result)
-                    if answer_report.deemed_acceptable:
-                        self.boto_client.approve_assignment(
-                            AssignmentId=assignment_id,
-                            OverrideRejection=False
-                        )
+    def update_results(self, datastore_client=None, hit_ids=None):
+        return run_sync(self.aupdate_results(datastore_client=datastore_client, hit_ids=hit_ids))
+
+    async def aupdate_results(self, datastore_client=None, hit_ids=None):
+        """
+        polls only the hits that are not ready yet. assignments_completed acts as a watermark of the assignments already seen per hit,
+        so assignments are only listed and parsed for hits that received new submissions since the last poll.
+        if hit_ids is given (e.g. the hits marked dirty by mturk notifications), only those hits are polled.
+        all hits are polled concurrently. reviews run in the background and are not waited for, the ones that failed by the next poll
+        are stored on the hit entities (failed_review_assignment_ids) and retried by that poll
+        """
+        review_changed_hit_ids = self.collect_review_failures()
+        outstanding_hit_ids = self.get_outstanding_hit_ids()
+
+        if hit_ids is not None:
+            hit_ids = set(hit_ids)
+            outstanding_hit_ids = [hit_id for hit_id in outstanding_hit_ids if hit_id in hit_ids]
+
+            # a notification means the cached status is out of date
+            for hit_id in outstanding_hit_ids:
+                self.status_cache.invalidate(hit_id)
+
+        nums_submitted_assignments = await asyncio.gather(*[self.acall(self.get_num_submitted_assignments, hit_id) for hit_id in outstanding_hit_ids])
+
+        changed_hit_ids = [hit_id for hit_id, num_submitted_assignments in zip(outstanding_hit_ids, nums_submitted_assignments) if
+                           num_submitted_assignments > self.launched_instances[hit_id]['assignments_completed'] or
+                           len(self.launched_instances[hit_id]['failed_review_assignment_ids']) > 0]
+
+        assignmentses = await asyncio.gather(*[self.acall(self.list_assignments_by_hit_id, hit_id) for hit_id in changed_hit_ids])
+
+        # parsing may judge answers over the network (see acceptable_answer), so it is kept off the event loop as well
+        await asyncio.gather(*[self.acall(self.parse_new_assignments, hit_id, assignments) for hit_id, assignments in zip(changed_hit_ids, assignmentses)])
+
+        if datastore_client is not None:
+            await self.acall(self.save_assignment_results, datastore_client)
+            saved_hit_ids = outstanding_hit_ids + [hit_id for hit_id in review_changed_hit_ids if hit_id not in outstanding_hit_ids]
+            await self.acall(save_launched_instances, datastore_client, [self.launched_instances[hit_id] for hit_id in saved_hit_ids],
+                             dirty_tracker=self.dirty_tracker)
+
+    def save_assignment_results(self, datastore_client):
+        """appends the results parsed since the last save to the assignment kind, keyed by assignment id so that saving twice is harmless"""
+        unsaved_assignment_results = list(self.unsaved_assignment_results)
+
+        put_multi(datastore_client, [new_assignment_entity(datastore_client, hit_id, assignment_id, result) for hit_id, assignment_id, result in
+                                     unsaved_assignment_results])
+
+        del self.unsaved_assignment_results[:len(unsaved_assignment_results)]
+
+    def parse_new_assignments(self, hit_id, assignments):
+        assignments_completed = len(assignments)
+        self.launched_instances[hit_id]['assignments_completed'] = assignments_completed
+        self.launched_instances[hit_id]['ready'] = assignments_completed == self.launched_instances[hit_id]['assignments_launched']
+
+        failed_review_assignment_ids = self.launched_instances[hit_id]['failed_review_assignment_ids']
+
+        parsed_results = []
+        for assignment in assignments:
+
+            # Retrieve the attributes for each Assignment
+            assignment_id = assignment['AssignmentId']
+
+            if assignment_id in self.launched_instances[hit_id]['assignment_ids_parsed']:
+                if assignment_id in failed_review_assignment_ids:
+                    # retried unless it was reviewed (or auto approved) in the meantime. it stays recorded until a poll sees the retry succeed
+                    if assignment['AssignmentStatus'] == 'Submitted':
+                        self.review_queue.submit(assignment_id, self.acceptable_answer(self.parse_assignment(assignment)), hit_id=hit_id)
                     else:
-                        self.boto_client.reject_assignment(
-                            AssignmentId=assignment_id,
-                            RequesterFeedback=answer_report.requester_feedback
-                        )
+                        failed_review_assignment_ids.remove(assignment_id)
+                continue
+
+            parsed_result = self.parse_assignment(assignment)
+            parsed_results.append(parsed_result)
+            self.unsaved_assignment_results.append((hit_id, assignment_id, parsed_result))
+
+            # Approve the Assignment (if it hasn't been already), the review queue does so in the background
+            if assignment['AssignmentStatus'] == 'Submitted':
+                self.review_queue.submit(assignment_id, self.acceptable_answer(parsed_result), hit_id=hit_id)
 
-                    self.launched_instances[hit_id]['assignment_ids_parsed'].append(assignment_id)
+            # assignments that were already reviewed are marked as parsed too, so that they are not parsed again on the next poll
+            self.launched_instances[hit_id]['assignment_ids_parsed'].append(assignment_id)
 
-            self.launched_instances[hit_id]['results'] += parsed_results
+            # when the hit was first picked up and worked on, for the scheduler's pickup latencies
+            first_submission_time = self.launched_instances[hit_id].get('first_submission_time')
+            if first_submission_time is None or assignment['SubmitTime'] < first_submission_time:
+                self.launched_instances[hit_id]['first_submission_time'] = assignment['SubmitTime']
 
-            if datastore_client is not None:
-                query = datastore_client.query(kind='hit')
-                query.add_filter('hit_id', '=', hit_id)
-                hit_entity = list(query.fetch())[0]
-                hit_entity.update(self.launched_instances[hit_id])
-                datastore_client.put(hit_entity)
+        self.launched_instances[hit_id]['results'] += parsed_results
+
+    def parse_assignment(self, assignment):
+        # Retrieve the value submitted by the Worker from the XML
+        answer_dict = xmltodict.parse(assignment['Answer'])
+        parsed_result = self.parse_answers(answer_dict)
+        parsed_result['worker_id'] = assignment['WorkerId']
+        parsed_result['submission_time'] = assignment['SubmitTime']
+        parsed_result['assignment_id'] = assignment['AssignmentId']
+        return parsed_result
 
     def acceptable_answer(self, parsed_answer):
         return AnswerReport(True, '')
 
+    def wait_for_reviews(self):
+        """
+        blocks until the queued reviews are done and records the failed ones on the launched instances, so that they are stored
+        and the next update reviews them anew instead of leaving them to be auto approved. returns the failed reviews
+        """
+        failures = self.review_queue.join()
+        self.collect_review_failures()
+
+        if len(failures) > 0:
+            print(f'{len(failures)} reviews failed, their assignments will be reviewed again on the next update: '
+                  f'{", ".join(failure.decision.assignment_id for failure in failures)}')
+
+        return failures
+
     def prepare_results(self, results):
         return results
 
     def completed(self, update=True):
+        return run_sync(self.acompleted(update=update))
+
+    async def acompleted(self, update=True):
 
         if update:
-            self.update_results()
+            await self.aupdate_results()
 
-        c = 0
-        for item in self.results:
-            c += self.boto_client.list_assignments_for_hit(
-                HITId=item['hit_id'],
-                AssignmentStatuses=['Submitted', 'Approved', 'Rejected'],
-            )['NumResults']
+        c = await self.apoll()
 
         return c == self.assignments_launched and self.assignments_launched > 0
 
     def poll(self):
+        return run_sync(self.apoll())
 
-        c = 0
-
-        for item in self.results:
-            c += self.boto_client.list_assignments_for_hit(
-                HITId=item['hit_id'],
-                AssignmentStatuses=['Submitted', 'Approved', 'Rejected'],
-            )['NumResults']
+    async def apoll(self):
+        # served from the status cache, so this shares api calls with update_results and other pollers
+        nums_submitted_assignments = await asyncio.gather(*[self.acall(self.get_num_submitted_assignments, item['hit_id']) for item in self.results])
 
-        return c
+        return sum(nums_submitted_assignments)
 
     def pbar(self):
 
@@ -393,13 +682,7 @@ def pbar_listener(hit_ids, total, production):
     with TqdmUpTo(total=total) as pbar:
 
         while c != total:
-            c = 0
-
-            for item in phb.results:
-                c += phb.boto_client.list_assignments_for_hit(
-                    HITId=item['hit_id'],
-                    AssignmentStatuses=['Submitted', 'Approved', 'Rejected'],
-                )['NumResults']
+            c = phb.poll()
 
             pbar.update_to(c)
             if c != total:
@@ -407,11 +690,13 @@ def pbar_listener(hit_ids, total, production):
 
 
 class PreexistingHit(Hit):
+    name = 'preexisting'
+    template_filename = ''
+    validate_task_attributes = False
 
     def __init__(self, hit_ids, production=False, update=True):
         super().__init__(
-            template_location=None,
-            hit_attributes=None,
+            hit_attributes={},
             production=production
         )
         self.hit_ids = hit_ids
@@ -422,6 +707,22 @@ class PreexistingHit(Hit):
         if update:
             self.update_results()
 
+    @classmethod
+    def from_hit_entities(cls, hit_entities, production=False):
+        """picks up polling where the stored hit entities left off, including their watermarks and parsed assignment ids"""
+        phb = cls(hit_ids=[hit_entity['hit_id'] for hit_entity in hit_entities], production=production, update=False)
+
+        for hit_entity in hit_entities:
+            # stored results are loaded lazily, see load_hit_results. the lists are copied, so parsing does not alter the entity read
+            phb.launched_instances[hit_entity['hit_id']] = {**hit_entity, 'results': [],
+                                                            'assignment_ids_parsed': list(hit_entity.get('assignment_ids_parsed', [])),
+                                                            'failed_review_assignment_ids': list(hit_entity.get('failed_review_assignment_ids', []))}
+            phb.dirty_tracker.mark_clean(phb.launched_instances[hit_entity['hit_id']])
+
+        phb.assignments_launched = sum(hit_entity['assignments_launched'] for hit_entity in hit_entities)
+
+        return phb
+
 
 def extract_free_text(answer_dict):
     if type(answer_dict['QuestionFormAnswers']['Answer']) is list:
@@ -439,36 +740,105 @@ class HitObserver:
     def __init__(self, datastore_client, production=False):
         self.datastore_client = datastore_client
         self.production = production
+        self.boto_client = get_mturk_client(production)
+
+    def list_hits(self):
+        hits = []
+
+        list_hits_response = self.boto_client.list_hits(MaxResults=100)
+        hits += list_hits_response['HITs']
+
+        while 'NextToken' in list_hits_response:
+            list_hits_response = self.boto_client.list_hits(MaxResults=100, NextToken=list_hits_response['NextToken'])
+            hits += list_hits_response['HITs']
+
+        return hits
+
+    def list_reviewable_hits(self, hit_type_id):
+        hits = []
+
+        list_reviewable_hits_response = self.boto_client.list_reviewable_hits(HITTypeId=hit_type_id, Status='Reviewable', MaxResults=100)
+        hits += list_reviewable_hits_response['HITs']
+
+        while 'NextToken' in list_reviewable_hits_response:
+            list_reviewable_hits_response = self.boto_client.list_reviewable_hits(
+                HITTypeId=hit_type_id,
+                Status='Reviewable',
+                MaxResults=100,
+                NextToken=list_reviewable_hits_response['NextToken']
+            )
+            hits += list_reviewable_hits_response['HITs']
+
+        return hits
+
+    def get_changed_hit_ids(self, hit_entities_by_hit_id):
+        hit_type_ids = {hit_entity['creation_response']['HIT']['HITTypeId'] for hit_entity in hit_entities_by_hit_id.values()}
+
+        reviewable_hit_ids = set()
+        for hit_type_id in hit_type_ids:
+            reviewable_hit_ids |= {hit['HITId'] for hit in self.list_reviewable_hits(hit_type_id)}
 
-    def update(self):
+        hits = [hit for hit in self.list_hits() if hit['HITId'] in hit_entities_by_hit_id]
+
+        # the listed statuses serve the following update_results, so it does not need a get_hit call per hit
+        Hit.status_cache.prime(hits)
+
+        return [hit['HITId'] for hit in hits if
+                hit['HITId'] in reviewable_hit_ids or get_num_submitted_assignments(hit) > hit_entities_by_hit_id[hit['HITId']]['assignments_completed'] or
+                len(hit_entities_by_hit_id[hit['HITId']].get('failed_review_assignment_ids', [])) > 0]
+
+    def sweep(self):
+        """
+        finds the active hits that received submissions with a few paged list_reviewable_hits and list_hits calls instead of polling
+        every hit, fetches assignments only for those hits and writes the changed entities back in batches
+        """
         query = self.datastore_client.query(kind='hit')
         query.add_filter('active', '=', True)
+        query.add_filter('production', '=', self.production)
+
+        hit_entities_by_hit_id = {hit_entity['hit_id']: hit_entity for hit_entity in decode_hit_entities(query.fetch())}
+        if len(hit_entities_by_hit_id) == 0:
+            return
 
-        hit_entities = query.fetch()
+        changed_hit_ids = self.get_changed_hit_ids(hit_entities_by_hit_id)
+        if len(changed_hit_ids) == 0:
+            return
 
-        batch = self.datastore_client.batch()
+        hb = PreexistingHit.from_hit_entities([hit_entities_by_hit_id[hit_id] for hit_id in changed_hit_ids], production=self.production)
+        hb.update_results()
+        hb.save_assignment_results(self.datastore_client)
+        hb.wait_for_reviews()  # a hit is only deactivated once its assignments are reviewed, failed reviews keep it active for the next sweep
 
-        with batch:
-            for hit_entity in hit_entities:
-                hb = PreexistingHit(hit_ids=[hit_entity['hit_id']], production=self.production)
-                if hb.completed():
-                    hit_entity.update(dict(
-                        active=False,
-                        results=hb.results
-                    ))
-                    batch.put(hit_entity)
+        changed_hit_entities = []
+        legacy_assignment_entities_to_save = []
+        for hit_id in changed_hit_ids:
+            launched_instance = hb.launched_instances[hit_id]
+
+            if launched_instance.get('ready', False) and len(launched_instance['failed_review_assignment_ids']) == 0:
+                launched_instance['active'] = False
+
+            changed_properties = hb.dirty_tracker.changed_properties(launched_instance)
+            if len(changed_properties) == 0:
+                hb.dirty_tracker.num_skipped_writes += 1
+                continue
+
+            hit_entity = hit_entities_by_hit_id[hit_id]
+            if 'results' in hit_entity:  # moved to the assignment kind, so carry the embedded results over before dropping them
+                legacy_assignment_entities_to_save += legacy_assignment_entities(self.datastore_client, hit_entity)
+                hit_entity.pop('results')
+            hit_entity.update({k: launched_instance[k] for k in changed_properties})
+            changed_hit_entities.append(encode_hit_entity(hit_entity))
+
+        put_multi(self.datastore_client, legacy_assignment_entities_to_save)  # before the hit entities lose their results
+        put_multi(self.datastore_client, changed_hit_entities)
+        hb.dirty_tracker.num_writes += len(changed_hit_entities)
 
 
 # todo: use decorator
 
 
 def delete_all_hits(production, loop=True, attempts=100):
-    boto_session = boto3.Session(profile_name=MTURK_PROFILE_NAME)
-    mturk = boto_session.client(
-        service_name=MTURK_PROFILE_NAME,
-        region_name=MTURK_REGION_NAME,
-        endpoint_url=MTURK_ENVIRONMENTS["production"]['endpoint'] if production else MTURK_ENVIRONMENTS["sandbox"]['endpoint'],
-    )
+    mturk = get_mturk_client(production)
 
     if not loop:
         attempts = 1
@@ -513,13 +883,7 @@ def delete_all_hits(production, loop=True, attempts=100):
 
 
 def reaprove_hit(hit_id):
-    boto_session = boto3.Session(profile_name=MTURK_PROFILE_NAME)
-
-    mturk = boto_session.client(
-        service_name=MTURK_PROFILE_NAME,
-        region_name=MTURK_REGION_NAME,
-        endpoint_url=MTURK_ENVIRONMENTS["production"]['endpoint']
-    )
+    mturk = get_mturk_client(production=True)
 
     mturk.approve_assignment(
         AssignmentId=hit_id,
@@ -553,12 +917,12 @@ class AnswerQuestionHit(Hit):
         return extract_free_text(answer_dict)
 
 
-def launch_hits(hb, batch_params, production=False, title_task_attributes=None, datastore_client=None, bar=False):
+def launch_hits(hb, batch_params, production=False, title_task_attributes=None, datastore_client=None, bar=False, max_workers=None):
     hb = hb(
         production=production,
     )
 
-    hb.launch_batch(hit_paramses=batch_params, datastore_client=datastore_client)
+    hb.launch_batch(hit_paramses=batch_params, datastore_client=datastore_client, max_workers=max_workers)
     if not production:
         hb.pbar()
         print(hb.results)
@@ -0,0 +1,206 @@
+import atexit
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image
+
+from config import IMAGE_CACHE_DIRECTORY, IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_MAX_WORKERS, IMAGE_CACHE_INDEX_SAVE_INTERVAL, IMAGE_VALIDATION_TIMEOUT
+from utils import CoalescingCache
+
+USER_AGENT = 'Mozilla/5.0 (compatible; alien-answers image check)'
+
+
+def download_image(image_location, timeout=IMAGE_VALIDATION_TIMEOUT):
+    request = urllib.request.Request(image_location, headers={'User-Agent': USER_AGENT})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read()
+
+
+def get_image_metadata(image_bytes):
+    """decodes the image header, raises an exception if image_bytes are not an image"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return dict(width=image.width, height=image.height, format=image.format)
+
+
+class ImageCache:
+    """
+    keeps downloaded images on disk so that every pipeline stage after the first reads them locally.
+    images are stored by the sha256 of their content (urls with the same image share a file) and the urls map to those hashes,
+    along with the decoded dimensions and format. beyond max_bytes, the least recently used images are evicted.
+    the index is written at most every index_save_interval seconds, call flush to write pending changes
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIRECTORY, max_bytes=IMAGE_CACHE_MAX_BYTES, download=download_image, max_workers=IMAGE_CACHE_MAX_WORKERS,
+                 index_save_interval=IMAGE_CACHE_INDEX_SAVE_INTERVAL):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.download = download
+        self.index_save_interval = index_save_interval
+
+        self.index_location = os.path.join(self.directory, 'index.json')
+        self.index_dirty = False
+        self.last_index_save_time = time.monotonic()
+        self.entries = dict()  # url -> dict(content_hash, size, width, height, format)
+        self.last_access_times = dict()  # content hash -> last access time
+        self.lock = threading.Lock()
+        # the images themselves live on disk, the in-memory cache only coalesces concurrent downloads of the same url
+        self.downloads = CoalescingCache(ttl=0, executor=ThreadPoolExecutor(max_workers=max_workers))
+        self.num_disk_hits = 0
+
+        self.load_index()
+
+    @property
+    def num_downloads(self):
+        return self.downloads.num_loads
+
+    @property
+    def num_cache_hits(self):
+        return self.num_disk_hits + self.downloads.num_cache_hits
+
+    def get_blob_location(self, content_hash):
+        return os.path.join(self.directory, content_hash)
+
+    def load_index(self):
+        if not os.path.exists(self.index_location):
+            return
+
+        with open(self.index_location, 'r') as f:
+            index = json.load(f)
+
+        # entries whose file went missing are dropped rather than trusted
+        self.entries = {url: entry for url, entry in index['entries'].items() if os.path.exists(self.get_blob_location(entry['content_hash']))}
+        self.last_access_times = {content_hash: t for content_hash, t in index['last_access_times'].items() if
+                                  os.path.exists(self.get_blob_location(content_hash))}
+
+    def save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_location = self.index_location + '.tmp'
+        with open(temporary_location, 'w') as f:
+            json.dump(dict(entries=self.entries, last_access_times=self.last_access_times), f)
+        os.replace(temporary_location, self.index_location)
+
+        self.index_dirty = False
+        self.last_index_save_time = time.monotonic()
+
+    def flush(self):
+        """writes the index if it changed since the last write"""
+        with self.lock:
+            if self.index_dirty:
+                self.save_index()
+
+    def contains(self, image_location):
+        with self.lock:
+            return image_location in self.entries
+
+    def get_metadata(self, image_location):
+        """dimensions and format of the image, downloading it if it is not cached yet"""
+        image_bytes = self.get(image_location)
+        with self.lock:
+            entry = self.entries.get(image_location)
+        if entry is None:  # evicted by other stores in the meantime
+            return get_image_metadata(image_bytes)
+        return dict(width=entry['width'], height=entry['height'], format=entry['format'])
+
+    def read(self, image_location):
+        with self.lock:
+            entry = self.entries.get(image_location)
+            if entry is None:
+                return None
+            self.last_access_times[entry['content_hash']] = time.time()
+            self.index_dirty = True  # the access times are saved along with the next store
+
+        try:
+            with open(self.get_blob_location(entry['content_hash']), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:  # evicted in the meantime
+            return None
+
+    def store(self, image_location, image_bytes):
+        metadata = get_image_metadata(image_bytes)
+        content_hash = hashlib.sha256(image_bytes).hexdigest()
+
+        blob_location = self.get_blob_location(content_hash)
+        if not os.path.exists(blob_location):
+            os.makedirs(self.directory, exist_ok=True)
+            temporary_location = blob_location + f'.{threading.get_ident()}.tmp'
+            with open(temporary_location, 'wb') as f:
+                f.write(image_bytes)
+            os.replace(temporary_location, blob_location)
+
+        with self.lock:
+            self.entries[image_location] = dict(content_hash=content_hash, size=len(image_bytes), **metadata)
+            self.last_access_times[content_hash] = time.time()
+            self.evict(kept_content_hash=content_hash)
+            self.index_dirty = True
+
+            if time.monotonic() - self.last_index_save_time >= self.index_save_interval:
+                self.save_index()
+
+    def evict(self, kept_content_hash=None):
+        # kept_content_hash is the image just stored, which its caller is about to read back even if it alone exceeds max_bytes
+        sizes = {entry['content_hash']: entry['size'] for entry in self.entries.values()}
+        total_bytes = sum(sizes.values())
+
+        for content_hash in sorted(sizes.keys(), key=lambda h: self.last_access_times.get(h, 0)):
+            if total_bytes <= self.max_bytes:
+                break
+            if content_hash == kept_content_hash:
+                continue
+
+            total_bytes -= sizes[content_hash]
+            self.last_access_times.pop(content_hash, None)
+            self.entries = {url: entry for url, entry in self.entries.items() if entry['content_hash'] != content_hash}
+            try:
+                os.remove(self.get_blob_location(content_hash))
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, image_location):
+        image_bytes = self.download(image_location)
+        self.store(image_location, image_bytes)
+        return image_bytes
+
+    def submit(self, image_location):
+        """returns a future of the image bytes, concurrent requests for the same url share one download"""
+        image_bytes = self.read(image_location)
+        if image_bytes is not None:
+            with self.lock:
+                self.num_disk_hits += 1
+            future = Future()
+            future.set_result(image_bytes)
+            return future
+
+        return self.downloads.submit(image_location, self.fetch)
+
+    def get(self, image_location):
+        return self.submit(image_location).result()
+
+    def get_image(self, image_location):
+        return Image.open(io.BytesIO(self.get(image_location)))
+
+    def prefetch(self, image_location):
+        """downloads the image in the background, failures are only reported"""
+        future = self.submit(image_location)
+        future.add_done_callback(lambda f: f.exception() is not None and print(f'could not prefetch {image_location}: {f.exception()!r}'))
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    """the cache shared by the whole process, built on first use so that importing this module does not touch the disk"""
+    global _image_cache
+
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache()
+            atexit.register(_image_cache.flush)
+
+        return _image_cache
@@ -0,0 +1,78 @@
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from config import IMAGE_VALIDATION_TTL, IMAGE_VALIDATION_TIMEOUT, IMAGE_VALIDATION_MAX_WORKERS
+from image_cache import get_image_cache, USER_AGENT
+from utils import CoalescingCache
+
+
+def fetch_is_image(image_location, timeout=IMAGE_VALIDATION_TIMEOUT):
+    """true if image_location answers with an image, only the response headers are read"""
+    if not image_location.lower().startswith(('http://', 'https://')):
+        return False
+
+    if get_image_cache().contains(image_location):  # it was downloaded and decoded as an image already
+        return True
+
+    request = urllib.request.Request(image_location, headers={'User-Agent': USER_AGENT})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status == 200 and response.headers.get_content_maintype() == 'image'
+    except urllib.error.HTTPError as e:
+        if 400 <= e.code < 500 and e.code not in (408, 429):  # the url is definitely not an image (404, 410, ...), worth caching
+            return False
+        raise  # timeouts, throttling and server errors may pass, so they are not cached
+
+
+class ImageValidator:
+    """
+    checks image urls concurrently and caches the verdict per url for ttl seconds, so that the flavour image hits and
+    the pipeline stages after them fetch each url at most once. concurrent checks of the same url are coalesced into one fetch.
+    a check that fails to connect, times out or gets a server error counts as invalid but is not cached
+    """
+
+    def __init__(self, check=fetch_is_image, ttl=IMAGE_VALIDATION_TTL, timeout=IMAGE_VALIDATION_TIMEOUT, max_workers=IMAGE_VALIDATION_MAX_WORKERS):
+        self.check = check
+        self.timeout = timeout
+        self.cache = CoalescingCache(ttl=ttl, executor=ThreadPoolExecutor(max_workers=max_workers))
+
+    @property
+    def num_checks(self):
+        return self.cache.num_loads
+
+    @property
+    def num_cache_hits(self):
+        return self.cache.num_cache_hits
+
+    def run_check(self, image_location):
+        try:
+            return self.check(image_location, timeout=self.timeout)
+        except Exception as e:
+            print(f'could not check {image_location}: {e!r}')
+            raise
+
+    def submit(self, image_location):
+        """returns a future of the verdict for image_location, which raises if the check failed"""
+        return self.cache.submit(image_location, self.run_check)
+
+    def is_valid(self, image_location):
+        return self.validate_many([image_location])[image_location]
+
+    def validate_many(self, image_locations):
+        """checks all image locations at once and returns the verdicts by location"""
+        futures = {image_location: self.submit(image_location) for image_location in set(image_locations)}
+
+        # no overall deadline, checks queued behind a full pool would be judged invalid without being run. each check is bounded by
+        # the socket timeout, a check that failed counts as invalid
+        return {image_location: future.exception() is None and bool(future.result()) for image_location, future in futures.items()}
+
+    def invalidate(self, image_location):
+        self.cache.invalidate(image_location)
+
+
+image_validator = ImageValidator()
+
+
+def is_image_and_ready(image_location):
+    return image_validator.is_valid(image_location)
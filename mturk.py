@@ -2,13 +2,15 @@ import collections
 import json
 import os
 
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 from config import DEFAULT_HIT_LIFETIME, DEFAULT_APPROVAL_DELAY, _DEFAULT_REWARD_PER_SECOND, MINUTE, DEFAULT_TASK_QUALIFICATIONS, us_high_school_qualification
 
 
 # from nlp import split_sentence
 # from reddit import get_submission_by_id
-from utils import filter_non_ascii
+from image_cache import get_image_cache
+from image_validation import is_image_and_ready
+from templates import get_jinja_environment, TEMPLATE_STRIPPED_CHARACTERS_KEY
+from utils import strip_non_ascii, strip_non_ascii_params
 
 
 
@@ -31,7 +33,7 @@ class AlienAnswersHitBatch(HitBatch):  # todo: introduce companion datastore ent
         return dict(submission_id=self.submission_id)
 
 
-def create_aa_hit_batch_from_hit_ids(hb, hit_ids, submission_id, production, update=True):
+def create_aa_hit_batch_from_hit_ids(hb, hit_ids, submission_id, production, update=True, dirty_hit_ids=None):
     hb = hb(
         task_attributes={},
         submission_id=submission_id,
@@ -44,7 +46,7 @@ def create_aa_hit_batch_from_hit_ids(hb, hit_ids, submission_id, production, upd
     hb.assignments_launched = len(hit_ids)
 
     if update:
-        hb.update_results()
+        hb.update_results(hit_ids=dirty_hit_ids)
 
     return hb
 
@@ -131,14 +133,21 @@ class WordEmphasisHitBatch(AlienAnswersHitBatch):
         )
 
     def get_hit_xml(self, params):
+        hit_question_xml, stripped_characters = self.render_hit_xml(params)
 
-        template_env = Environment(
-            loader=FileSystemLoader(os.path.join(get_relative_project_root(), 'hit templates')),
-            autoescape=select_autoescape(['html'])
-        )
+        if len(stripped_characters) > 0:
+            print(f'removed non ascii characters from word emphasis question xml: {stripped_characters}')
+
+        return hit_question_xml
+
+    def render_hit_xml(self, params):
+
+        template_env = get_jinja_environment(os.path.join(get_relative_project_root(), 'hit templates'))
 
         hit_template = template_env.get_template('word emphasis hit.html')
 
+        params, stripped_characters = strip_non_ascii_params(params)
+
         # words = get_tokens_text(params['title'])
         words = params['title'].split()
 
@@ -146,11 +155,11 @@ class WordEmphasisHitBatch(AlienAnswersHitBatch):
 
         hit_question_xml = QUESTION_XML.format(html)
 
-        filtered_hit_question_xml = filter_non_ascii(hit_question_xml)
-        if filtered_hit_question_xml != hit_question_xml:
-            pass  # todo: log
+        filtered_hit_question_xml, stripped_template_characters = strip_non_ascii(hit_question_xml)
+        if stripped_template_characters:
+            stripped_characters[TEMPLATE_STRIPPED_CHARACTERS_KEY] = stripped_template_characters
 
-        return filtered_hit_question_xml
+        return filtered_hit_question_xml, stripped_characters
 
     def parse_answers(self, answer_dict):
         if type(answer_dict) != collections.OrderedDict:
@@ -228,9 +237,12 @@ class FlavourImageHitBatch(AlienAnswersHitBatch):
 
     def acceptable_answer(self, parsed_answer):
         image_location = parsed_answer['image location']
-        if is_image_and_ready(image_location) or image_location.lower().endswith('.jpg') or image_location.lower().endswith('.png'):
-            if not is_image_and_ready(image_location):
+        image_ready = is_image_and_ready(image_location)
+        if image_ready or image_location.lower().endswith('.jpg') or image_location.lower().endswith('.png'):
+            if not image_ready:
                 print(f'would have liked to reject {image_location}')
+            else:
+                get_image_cache().prefetch(image_location)  # later stages render from it
             return AnswerReport(True, '')
         else:
             print(f'rejecting {image_location}')
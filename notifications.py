@@ -0,0 +1,173 @@
+import datetime
+import json
+import queue
+import threading
+import uuid
+from abc import ABC, abstractmethod
+
+import boto3
+
+from config import MTURK_PROFILE_NAME, MTURK_REGION_NAME
+
+NOTIFICATION_VERSION = '2014-08-15'
+DEFAULT_EVENT_TYPES = ('AssignmentSubmitted', 'HITReviewable')
+
+
+class NotificationQueue(ABC):
+    """
+    a queue mturk publishes hit events to. messages are received as (receipt, body) pairs and acknowledged by receipt
+    """
+
+    @property
+    @abstractmethod
+    def transport(self):
+        pass
+
+    @property
+    @abstractmethod
+    def destination(self):
+        pass
+
+    @abstractmethod
+    def receive(self, max_messages=10, wait_time=20):
+        pass
+
+    @abstractmethod
+    def acknowledge(self, receipts):
+        pass
+
+
+class SqsNotificationQueue(NotificationQueue):
+    transport = 'SQS'
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        boto_session = boto3.Session(profile_name=MTURK_PROFILE_NAME)
+        self.sqs_client = boto_session.client(service_name='sqs', region_name=MTURK_REGION_NAME)
+
+    @property
+    def destination(self):
+        return self.queue_url
+
+    def receive(self, max_messages=10, wait_time=20):
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=wait_time,
+        )
+        return [(message['ReceiptHandle'], message['Body']) for message in response.get('Messages', [])]
+
+    def acknowledge(self, receipts):
+        for i in range(0, len(receipts), 10):  # sqs deletes at most 10 messages per batch
+            self.sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(j), 'ReceiptHandle': receipt} for j, receipt in enumerate(receipts[i:i + 10])],
+            )
+
+
+class InProcessNotificationQueue(NotificationQueue):
+    """
+    stand in for an sqs queue that lives in the current process, events are published to it by hand (e.g. in tests or sandbox runs)
+    """
+    transport = 'SQS'
+    destination = None  # nothing to register with mturk
+
+    def __init__(self):
+        self.messages = queue.Queue()
+
+    def publish(self, event_type, hit_id, hit_type_id=None, assignment_id=None):
+        self.messages.put(json.dumps(dict(
+            EventDocId=str(uuid.uuid4()),
+            EventDocVersion=NOTIFICATION_VERSION,
+            Events=[dict(
+                EventType=event_type,
+                EventTimestamp=datetime.datetime.utcnow().isoformat(),
+                HITId=hit_id,
+                HITTypeId=hit_type_id,
+                AssignmentId=assignment_id,
+            )],
+        )))
+
+    def receive(self, max_messages=10, wait_time=20):
+        messages = []
+
+        try:
+            messages.append(self.messages.get(timeout=wait_time))
+            while len(messages) < max_messages:
+                messages.append(self.messages.get_nowait())
+        except queue.Empty:
+            pass
+
+        return [(None, message) for message in messages]
+
+    def acknowledge(self, receipts):
+        pass
+
+
+def register_notification_settings(boto_client, hit_type_id, notification_queue, event_types=DEFAULT_EVENT_TYPES):
+    if notification_queue.destination is None:
+        return
+
+    boto_client.update_notification_settings(
+        HITTypeId=hit_type_id,
+        Notification={
+            'Destination': notification_queue.destination,
+            'Transport': notification_queue.transport,
+            'Version': NOTIFICATION_VERSION,
+            'EventTypes': list(event_types),
+        },
+        Active=True,
+    )
+
+
+class HitEventConsumer:
+    """
+    consumes mturk hit events from a notification queue and collects the ids of the hits they concern as dirty,
+    so that only those hits need to be updated and propagated
+    """
+
+    def __init__(self, notification_queue, event_types=DEFAULT_EVENT_TYPES):
+        self.notification_queue = notification_queue
+        self.event_types = event_types
+
+        self.registered_hit_type_ids = set()
+        self.dirty_hit_ids = set()
+        self.lock = threading.Lock()
+
+    def register_hit_type(self, boto_client, hit_type_id):
+        with self.lock:
+            if hit_type_id in self.registered_hit_type_ids:
+                return
+            self.registered_hit_type_ids.add(hit_type_id)
+
+        register_notification_settings(boto_client, hit_type_id, self.notification_queue, event_types=self.event_types)
+
+    def poll(self, wait_time=20):
+        """receives the available messages and returns the number of hits they marked dirty"""
+        messages = self.notification_queue.receive(wait_time=wait_time)
+
+        hit_ids = set()
+        for _, body in messages:
+            for event in json.loads(body).get('Events', []):
+                if event.get('EventType') in self.event_types and event.get('HITId') is not None:
+                    hit_ids.add(event['HITId'])
+
+        with self.lock:
+            self.dirty_hit_ids |= hit_ids
+
+        receipts = [receipt for receipt, _ in messages if receipt is not None]
+        if len(receipts) > 0:
+            self.notification_queue.acknowledge(receipts)
+
+        return len(hit_ids)
+
+    def mark_dirty(self, hit_ids):
+        with self.lock:
+            self.dirty_hit_ids |= set(hit_ids)
+
+    def pop_dirty_hit_ids(self):
+        with self.lock:
+            dirty_hit_ids = self.dirty_hit_ids
+            self.dirty_hit_ids = set()
+
+        return dirty_hit_ids
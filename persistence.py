@@ -0,0 +1,249 @@
+import hashlib
+import json
+
+from google.cloud import datastore
+
+from compression import default_codec, encode_entity_properties, decode_entity_properties, benchmark_entities, is_encoded
+from config import DATASTORE_BATCH_LIMIT, COMPRESS_LARGE_HIT_PROPERTIES
+
+HIT_PROPERTIES_EXCLUDED_FROM_INDEXES = ('creation_response', 'results')
+HIT_PROPERTIES_NOT_STORED = ('results',)  # parsed results are stored as assignment entities instead
+ASSIGNMENT_PROPERTIES_EXCLUDED_FROM_INDEXES = ('result',)
+COMPRESSED_HIT_PROPERTIES = ('creation_response', 'results', 'additional_properties')
+
+
+def chunked(items, chunk_size=DATASTORE_BATCH_LIMIT):
+    items = list(items)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def get_multi(datastore_client, keys):
+    entities = []
+    for keys_chunk in chunked(keys):
+        entities += datastore_client.get_multi(keys_chunk)
+    return entities
+
+
+def put_multi(datastore_client, entities):
+    for entities_chunk in chunked(entities):
+        datastore_client.put_multi(entities_chunk)
+
+
+def delete_multi(datastore_client, keys):
+    for keys_chunk in chunked(keys):
+        datastore_client.delete_multi(keys_chunk)
+
+
+def hit_key(datastore_client, hit_id):
+    return datastore_client.key('hit', hit_id)
+
+
+def stored_hit_properties(launched_instance):
+    return {k: v for k, v in launched_instance.items() if k not in HIT_PROPERTIES_NOT_STORED}
+
+
+def encode_hit_entity(hit_entity, codec=default_codec):
+    if COMPRESS_LARGE_HIT_PROPERTIES:
+        encode_entity_properties(hit_entity, COMPRESSED_HIT_PROPERTIES, codec=codec)
+    return hit_entity
+
+
+def decode_hit_entity(hit_entity, codec=default_codec):
+    return decode_entity_properties(hit_entity, COMPRESSED_HIT_PROPERTIES, codec=codec)
+
+
+def decode_hit_entities(hit_entities, codec=default_codec):
+    return [decode_hit_entity(hit_entity, codec=codec) for hit_entity in hit_entities]
+
+
+def encoded_hit_entity_copy(hit_entity, codec=default_codec):
+    """an encoded copy for writing elsewhere (e.g. archiving), leaving the decoded entity untouched for further use"""
+    encoded_hit_entity = datastore.Entity(hit_entity.key, exclude_from_indexes=tuple(hit_entity.exclude_from_indexes))
+    encoded_hit_entity.update(hit_entity)
+    return encode_hit_entity(encoded_hit_entity, codec=codec)
+
+
+def new_hit_entity(datastore_client, launched_instance):
+    hit_entity = datastore.Entity(
+        hit_key(datastore_client, launched_instance['hit_id']),
+        exclude_from_indexes=HIT_PROPERTIES_EXCLUDED_FROM_INDEXES
+    )
+    hit_entity.update(stored_hit_properties(launched_instance))
+    return encode_hit_entity(hit_entity)
+
+
+def assignment_key(datastore_client, hit_id, assignment_id):
+    # the hit is the ancestor, so the assignments of a hit can be queried with strong consistency
+    return datastore_client.key('hit', hit_id, 'assignment', assignment_id)
+
+
+def new_assignment_entity(datastore_client, hit_id, assignment_id, result):
+    assignment_entity = datastore.Entity(
+        assignment_key(datastore_client, hit_id, assignment_id),
+        exclude_from_indexes=ASSIGNMENT_PROPERTIES_EXCLUDED_FROM_INDEXES
+    )
+    assignment_entity.update(dict(
+        hit_id=hit_id,
+        assignment_id=assignment_id,
+        worker_id=result.get('worker_id'),
+        submission_time=result.get('submission_time'),
+        result=result,
+    ))
+    return assignment_entity
+
+
+def get_assignment_results(datastore_client, hit_id):
+    query = datastore_client.query(kind='assignment', ancestor=hit_key(datastore_client, hit_id))
+    assignment_entities = sorted(query.fetch(), key=lambda assignment_entity: str(assignment_entity['submission_time']))
+    return [assignment_entity['result'] for assignment_entity in assignment_entities]
+
+
+def get_legacy_answers(hit_entity):
+    """
+    the parsed results embedded in hit entities written before results moved to the assignment kind. those were stored either as
+    the list of parsed results itself or as hit batch results, i.e. dicts holding the hit_id and its answers
+    """
+    legacy_results = hit_entity.get('results') or []
+    if isinstance(legacy_results, dict):
+        legacy_results = [legacy_results]
+
+    answers = []
+    for legacy_result in legacy_results:
+        if isinstance(legacy_result, dict) and 'answers' in legacy_result:
+            answers += legacy_result['answers']
+        elif isinstance(legacy_result, dict) and set(legacy_result.keys()) == {'hit_id'}:
+            continue  # a hit batch result that was never filled in
+        else:
+            answers.append(legacy_result)
+
+    return answers
+
+
+def answer_identity(answer):
+    # legacy answers carry no assignment id, but a worker submits an assignment of a hit only once
+    return answer.get('worker_id'), str(answer.get('submission_time'))
+
+
+def legacy_assignment_entities(datastore_client, hit_entity):
+    """assignment entities for the legacy answers of a hit entity, so that they survive dropping its embedded results"""
+    legacy_answers = get_legacy_answers(hit_entity)
+
+    # legacy answers were parsed in the order of assignment_ids_parsed, but only trust that if the counts agree
+    assignment_ids = hit_entity.get('assignment_ids_parsed') or []
+    if len(assignment_ids) != len(legacy_answers):
+        assignment_ids = [f'legacy-{i}' for i in range(len(legacy_answers))]
+
+    return [new_assignment_entity(datastore_client, hit_entity['hit_id'], assignment_id, answer) for assignment_id, answer in
+            zip(assignment_ids, legacy_answers)]
+
+
+def load_hit_results(datastore_client, hit_entity):
+    """
+    loads the results of a hit from its assignment entities only when asked for, instead of with every read of the hit entity.
+    answers still embedded in the hit entity (written before results moved to their own kind) are merged in
+    """
+    answers = get_assignment_results(datastore_client, hit_entity['hit_id'])
+
+    answer_identities = {answer_identity(answer) for answer in answers}
+    answers += [legacy_answer for legacy_answer in get_legacy_answers(hit_entity) if answer_identity(legacy_answer) not in answer_identities]
+
+    answers.sort(key=lambda answer: str(answer.get('submission_time')))
+
+    return dict(hit_id=hit_entity['hit_id'], answers=answers)
+
+
+def get_hit_entities(datastore_client, hit_ids):
+    """looks hit entities up by key, hits without an entity are left out of the returned dict"""
+    hit_entities = get_multi(datastore_client, [hit_key(datastore_client, hit_id) for hit_id in hit_ids])
+    return {hit_entity.key.name: decode_hit_entity(hit_entity) for hit_entity in hit_entities}
+
+
+def property_fingerprint(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode('utf-8'), digest_size=16).digest()
+
+
+class DirtyTracker:
+    """
+    remembers a fingerprint per property of every record as it was last written (or read), so that records which did not change
+    since are never written again and only the properties that did change are merged into their stored entities
+    """
+
+    def __init__(self, id_property='hit_id', ignored_properties=()):
+        self.id_property = id_property
+        self.ignored_properties = ignored_properties
+        self.fingerprints = dict()
+
+        self.num_writes = 0
+        self.num_skipped_writes = 0
+
+    def changed_properties(self, record):
+        fingerprints = self.fingerprints.get(record[self.id_property], dict())
+        return {k for k, v in record.items() if k not in self.ignored_properties and fingerprints.get(k) != property_fingerprint(v)}
+
+    def mark_clean(self, record):
+        self.fingerprints[record[self.id_property]] = {k: property_fingerprint(v) for k, v in record.items() if k not in self.ignored_properties}
+
+
+def save_launched_instances(datastore_client, launched_instances, dirty_tracker=None):
+    """
+    merges launched instances into their hit entities, keeping properties that only the stored entities have.
+    with a dirty tracker, launched instances that did not change since they were last saved are skipped and only changed properties are merged
+    """
+    changed_properties_by_hit_id = dict()
+
+    if dirty_tracker is not None:
+        for launched_instance in launched_instances:
+            changed_properties = dirty_tracker.changed_properties(launched_instance)
+            if len(changed_properties) > 0:
+                changed_properties_by_hit_id[launched_instance['hit_id']] = changed_properties
+
+        dirty_tracker.num_skipped_writes += len(launched_instances) - len(changed_properties_by_hit_id)
+        launched_instances = [launched_instance for launched_instance in launched_instances if launched_instance['hit_id'] in changed_properties_by_hit_id]
+
+    if len(launched_instances) == 0:
+        return
+
+    hit_entities = get_hit_entities(datastore_client, [launched_instance['hit_id'] for launched_instance in launched_instances])
+
+    updated_hit_entities = []
+    for launched_instance in launched_instances:
+        hit_id = launched_instance['hit_id']
+
+        hit_entity = hit_entities.get(hit_id)
+        if hit_entity is None:
+            hit_entity = new_hit_entity(datastore_client, launched_instance)
+        elif hit_id in changed_properties_by_hit_id:
+            # datastore always writes whole entities, but merging only what changed keeps other writers' properties intact
+            hit_entity.update({k: launched_instance[k] for k in changed_properties_by_hit_id[hit_id]})
+        else:
+            hit_entity.update(stored_hit_properties(launched_instance))
+
+        updated_hit_entities.append(encode_hit_entity(hit_entity))
+
+    put_multi(datastore_client, updated_hit_entities)
+
+    if dirty_tracker is not None:
+        dirty_tracker.num_writes += len(launched_instances)
+        for launched_instance in launched_instances:
+            dirty_tracker.mark_clean(launched_instance)
+
+
+def migrate_hit_entities(datastore_client, kinds=('hit', 'archived_hit'), codec=default_codec, dry_run=False):
+    """
+    encodes the large properties of existing hit and archived hit entities that are still stored raw.
+    returns a benchmark of the migrated entities per kind, with dry_run nothing is written
+    """
+    benchmarks = dict()
+
+    for kind in kinds:
+        query = datastore_client.query(kind=kind)
+        raw_hit_entities = [hit_entity for hit_entity in query.fetch() if
+                            any(k in hit_entity and not is_encoded(hit_entity[k]) for k in COMPRESSED_HIT_PROPERTIES)]
+
+        benchmarks[kind] = dict(num_entities=len(raw_hit_entities), **benchmark_entities(raw_hit_entities, COMPRESSED_HIT_PROPERTIES, codec=codec))
+
+        if not dry_run:
+            put_multi(datastore_client, [encode_entity_properties(hit_entity, COMPRESSED_HIT_PROPERTIES, codec=codec) for hit_entity in raw_hit_entities])
+
+    return benchmarks
@@ -1,11 +1,21 @@
 import datetime
 import random
 import io
+import threading
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-
+from clients import get_mturk_client
 from competition import CompetitionFFAWTA
+from config import PIPELINE_MAX_WORKERS
+from image_cache import get_image_cache
+from image_validation import image_validator
+from scheduling import SubmissionScheduler
+from storage import delete_blobs
+from templates import preload_templates
+from thumbnail_rendering import ThumbnailJob, render_thumbnails, get_render_pool
+from persistence import get_hit_entities, get_multi, load_hit_results, decode_hit_entity, decode_hit_entities, encode_hit_entity, encoded_hit_entity_copy
 
 # from config.cfg import NUM_ALL_TIME_TOP_POSTS_PER_DAY, NUM_WEEKLY_TOP_POSTS_PER_DAY, NUM_FLAVOUR_IMAGE_HITS, NUM_THUMBNAIL_RATING_HITS, \
 #     NUM_VIDEO_TITLE_HITS, NUM_VIDEO_TITLE_RATING_HITS
@@ -128,6 +138,60 @@ def unarchive_datastore_entity(entity, datastore_client):
 #     datastore_client.delete(hit_entity.key)
 
 
+class SubmissionState:
+    """
+    the hit entities of one submission, indexed once per propagate call by hit_id, hit_type and active/inactive
+    so the stage functions can look entities up instead of scanning lists. their results are loaded lazily, once per hit
+    """
+
+    def __init__(self, submission_id, hit_entities, datastore_client=None):
+        self.submission_id = submission_id
+        self.hit_entities = list(hit_entities)
+        self.datastore_client = datastore_client
+        self.hit_results_by_hit_id = {}
+
+        self.active_hit_entities = []
+        self.inactive_hit_entities = []
+        self.hit_entities_by_hit_id = {}
+        self.hit_entities_by_hit_type = {True: {}, False: {}}
+
+        for hit_entity in self.hit_entities:
+            active = bool(hit_entity['active'])
+
+            if active:
+                self.active_hit_entities.append(hit_entity)
+            else:
+                self.inactive_hit_entities.append(hit_entity)
+
+            self.hit_entities_by_hit_id[hit_entity['hit_id']] = hit_entity
+            self.hit_entities_by_hit_type[active].setdefault(hit_entity['hit_type'], []).append(hit_entity)
+
+    def get_hit_entity(self, hit_id, active=None):
+        """raises a KeyError if the submission has no such hit, or if its active state differs from the given one"""
+        hit_entity = self.hit_entities_by_hit_id[hit_id]
+        if active is not None and bool(hit_entity['active']) != active:
+            raise KeyError(hit_id)
+        return hit_entity
+
+    def get_hit_entities_by_hit_type(self, hit_type, active=None):
+        if active is None:
+            return self.hit_entities_by_hit_type[True].get(hit_type, []) + self.hit_entities_by_hit_type[False].get(hit_type, [])
+        return self.hit_entities_by_hit_type[active].get(hit_type, [])
+
+    def get_first_hit_entity_by_hit_type(self, hit_type, active=None):
+        return self.get_hit_entities_by_hit_type(hit_type, active=active)[0]
+
+    def get_hit_result(self, hit_entity):
+        """the results of a hit as dict(hit_id=..., answers=[...]), read from the assignment kind on first use"""
+        hit_id = hit_entity['hit_id']
+        if hit_id not in self.hit_results_by_hit_id:
+            self.hit_results_by_hit_id[hit_id] = load_hit_results(self.datastore_client, hit_entity)
+        return self.hit_results_by_hit_id[hit_id]
+
+    def get_hit_results(self, hit_type, active=True):
+        return [self.get_hit_result(hit_entity) for hit_entity in self.get_hit_entities_by_hit_type(hit_type, active=active)]
+
+
 def correct_question(question):
     question = question.strip()
     question = question[0].upper() + question[1:]
@@ -136,11 +200,11 @@ def correct_question(question):
     return question
 
 
-def propagate_video_titles(hit_batches, active_hit_entities, inactive_hit_entities, datastore_client, production):
+def propagate_video_titles(hit_batches, submission_state, datastore_client, production):
     print('\tpropagating video titles')
 
     video_title_hit_batch = hit_batches['video title']
-    video_title_results = video_title_hit_batch.results
+    video_title_results = submission_state.get_hit_results('video title')
 
     video_titles_by_hit_id = {}
 
@@ -168,7 +232,7 @@ def propagate_video_titles(hit_batches, active_hit_entities, inactive_hit_entiti
     return True, False, False
 
 
-def propagate_title_ratings(hit_batches, active_hit_entities, inactive_hit_entities, datastore_client, production):
+def propagate_title_ratings(hit_batches, submission_state, datastore_client, production):
     print('\tpropagating title ratings')
 
     title_rating_hit_batch = hit_batches['title rating']
@@ -176,14 +240,14 @@ def propagate_title_ratings(hit_batches, active_hit_entities, inactive_hit_entit
     competition = CompetitionFFAWTA(match_size=3)
     all_video_titles = set()
 
-    for title_rating_result in title_rating_hit_batch.results:
+    for title_rating_result in submission_state.get_hit_results('title rating'):
         video_rating_hit_id = title_rating_result['hit_id']
         try:
             ratings = title_rating_result['answers'][0]
         except Exception:
             print('')
 
-        video_rating_hit_entity = list(filter(lambda e: e['hit_id'] == video_rating_hit_id, active_hit_entities))[0]
+        video_rating_hit_entity = submission_state.get_hit_entity(video_rating_hit_id, active=True)
         video_titles = video_rating_hit_entity['video_titles']
         for video_title in video_titles:
             all_video_titles.add(video_title)
@@ -203,18 +267,20 @@ def propagate_title_ratings(hit_batches, active_hit_entities, inactive_hit_entit
     return True, False, False
 
 
-def propagate_flavour_images(hit_batches, active_hit_entities, inactive_hit_entities, datastore_client, production):
+def propagate_flavour_images(hit_batches, submission_state, datastore_client, production):
     print('\tpropagating flavour images')
 
     hit_batch = hit_batches['flavour image']
-    results = hit_batch.results
+    results = submission_state.get_hit_results('flavour image')
     image_locations = []
     for result in results:
         for answer in result['answers']:
             image_locations.append(answer['image location'])
 
-    valid_image_locations = list(filter(is_image_and_ready, image_locations))
-    invalid_image_locations = list(filter(lambda x: not is_image_and_ready(x), image_locations))
+    # the verdicts are mostly cached already, from when the answers were judged in acceptable_answer
+    image_verdicts = image_validator.validate_many(image_locations)
+    valid_image_locations = [image_location for image_location in image_locations if image_verdicts[image_location]]
+    invalid_image_locations = [image_location for image_location in image_locations if not image_verdicts[image_location]]
 
     # print('\n'.join(invalid_image_locations))
     # return False, False, False
@@ -242,61 +308,37 @@ def has_solid_background(result):
     return result['answers'][0]['has_background'] and result['answers'][0]['background_solid']
 
 
-def ready_thumbnails_for_rating(hit_batches, active_hit_entities, inactive_hit_entities, datastore_client, production):
+def ready_thumbnails_for_rating(hit_batches, submission_state, datastore_client, production):
     print('\treadying thumbnails for rating')
 
     image_background_hit_batch = hit_batches['image background']
-    image_background_results = image_background_hit_batch.results
+    image_background_results = submission_state.get_hit_results('image background')
 
-    word_emphasis_hit_entity = list(filter(lambda e: e['hit_type'] == 'word emphasis', active_hit_entities))[0]
+    word_emphasis_hit_entity = submission_state.get_first_hit_entity_by_hit_type('word emphasis', active=True)
     video_title = word_emphasis_hit_entity['title']
 
-    word_emphasis_hit_batch = hit_batches['word emphasis']
-    word_emphasis_results = word_emphasis_hit_batch.results
-
-    thumbnails = {}
-    submission = None
+    emphasis_mask = submission_state.get_hit_result(word_emphasis_hit_entity)['answers'][0]['emphasis_mask']
 
+    jobs = []
     for result in image_background_results:
         hit_id = result['hit_id']
-
-        hit_entity = list(filter(lambda e: e['hit_id'] == hit_id, active_hit_entities))[0]
-        image_location = hit_entity['image_location']
-
-        if submission is None:
-            submission = get_submission_by_id(hit_entity['submission_id'])
-
-        emphasis_mask = word_emphasis_results[0]['answers'][0]['emphasis_mask']
-
-        flavour_image = FlavourImage(
-            image=image_from_url(image_location),
+        hit_entity = submission_state.get_hit_entity(hit_id, active=True)
+
+        jobs.append(ThumbnailJob(
+            hit_id=hit_id,
+            submission_id=hit_entity['submission_id'],
+            video_title=video_title,
+            emphasis_mask=emphasis_mask,
+            image_location=hit_entity['image_location'],
             has_solid_background=has_solid_background(result),
             background_coords=tuple(result['answers'][0]['background_coords']),
-        )
-
-        thumbnail = get_thumbnail(submission, video_title, color_scheme='dark', emphasis_mask=emphasis_mask, flavour_image=flavour_image, language_code='en')
-
-        thumbnails[hit_id] = thumbnail
+        ))
 
     storage_client = get_storage_client()
     bucket = storage_client.get_bucket('candidate_thumbnails')
 
-    image_urls_by_hit_id = {}
-
-    for hit_id, thumbnail in thumbnails.items():
-        filename = hit_id + '.jpg'
-        blob = bucket.blob(filename)
-
-        with io.BytesIO() as output:
-            thumbnail.save(output, format="JPEG")
-            blob.upload_from_string(output.getvalue())
-        blob.make_public()
-
-        image_urls_by_hit_id[hit_id] = blob.public_url
-
-        # b = bucket.get_blob(hit_id + '.jpg')
-        # fp = io.BytesIO(b.download_as_string())
-        # im = Image.open(fp)
+    # downloads, renders (on a process pool) and uploads the thumbnails concurrently
+    image_urls_by_hit_id = render_thumbnails(jobs, bucket)
 
     competition = CompetitionFFAWTA(match_size=3)
 
@@ -318,7 +360,7 @@ def ready_thumbnails_for_rating(hit_batches, active_hit_entities, inactive_hit_e
     return True, False, False
 
 
-def finalize_thumbnail(hit_batches, active_hit_entities, inactive_hit_entities, datastore_client, production):
+def finalize_thumbnail(hit_batches, submission_state, datastore_client, production):
     print('\tfinalizing thumbnails')
 
     thumbnail_rating_hit_batch = hit_batches['thumbnail rating']
@@ -326,11 +368,11 @@ def finalize_thumbnail(hit_batches, active_hit_entities, inactive_hit_entities,
     competition = CompetitionFFAWTA(match_size=3)
     all_thumbnail_urls = set()
 
-    for thumbnail_rating_result in thumbnail_rating_hit_batch.results:
+    for thumbnail_rating_result in submission_state.get_hit_results('thumbnail rating'):
         thumbnail_rating_hit_id = thumbnail_rating_result['hit_id']
         ratings = thumbnail_rating_result['answers'][0]
 
-        thumbnail_rating_hit_entity = list(filter(lambda e: e['hit_id'] == thumbnail_rating_hit_id, active_hit_entities))[0]
+        thumbnail_rating_hit_entity = submission_state.get_hit_entity(thumbnail_rating_hit_id, active=True)
         image_urls = thumbnail_rating_hit_entity['image_urls']
         for image_url in image_urls:
             all_thumbnail_urls.add(image_url)
@@ -351,12 +393,12 @@ def finalize_thumbnail(hit_batches, active_hit_entities, inactive_hit_entities,
     best_thumbnail_id = competition.best_id()
 
     try:
-        image_background_hit_entity_for_best_flavour_image = list(filter(lambda e: e['hit_id'] == best_thumbnail_id, inactive_hit_entities))[0]
+        image_background_hit_entity_for_best_flavour_image = submission_state.get_hit_entity(best_thumbnail_id, active=False)
     except Exception:
         print()
 
     best_flavour_image_location = image_background_hit_entity_for_best_flavour_image['image_location']
-    best_flavour_image = image_from_url(best_flavour_image_location).convert('RGB')
+    best_flavour_image = get_image_cache().get_image(best_flavour_image_location).convert('RGB')
 
     best_flavour_images_bucket = storage_client.get_bucket('best_flavour_images')
 
@@ -369,7 +411,7 @@ def finalize_thumbnail(hit_batches, active_hit_entities, inactive_hit_entities,
         best_flavour_image_blob.upload_from_string(output.getvalue())
 
     # create video formula
-    image_background_result = image_background_hit_entity_for_best_flavour_image['results']
+    image_background_result = submission_state.get_hit_result(image_background_hit_entity_for_best_flavour_image)
 
     if has_solid_background(image_background_result):
         background_coords = tuple(image_background_result['answers'][0]['background_coords'])
@@ -377,18 +419,16 @@ def finalize_thumbnail(hit_batches, active_hit_entities, inactive_hit_entities,
     else:
         background_color = None
 
-    word_emphasis_hit_entity = list(filter(lambda e: e['hit_type'] == 'word emphasis', inactive_hit_entities))[0]
+    word_emphasis_hit_entity = submission_state.get_first_hit_entity_by_hit_type('word emphasis', active=False)
     video_title = word_emphasis_hit_entity['title']
 
     video_formula_entity = datastore.Entity(
         datastore_client.key('video_formula', thumbnail_rating_hit_batch.submission_id),
     )
 
-    word_emphasis_hit_entity = list(filter(lambda e: e['hit_type'] == 'word emphasis', inactive_hit_entities))[0]
-    emphasis_mask = word_emphasis_hit_entity['results']['answers'][0]['emphasis_mask']
+    emphasis_mask = submission_state.get_hit_result(word_emphasis_hit_entity)['answers'][0]['emphasis_mask']
 
-    video_tags_hit_batch = hit_batches['video tags']
-    additional_tags = video_tags_hit_batch.results[0]['answers'][0]['video tags']
+    additional_tags = submission_state.get_hit_results('video tags')[0]['answers'][0]['video tags']
 
     video_formula_entity.update(dict(
         submission_id=thumbnail_rating_hit_batch.submission_id,
@@ -405,10 +445,9 @@ def finalize_thumbnail(hit_batches, active_hit_entities, inactive_hit_entities,
     # delete other thumbnail blobs for submission
 
     candidate_thumbnails_bucket = storage_client.get_bucket('candidate_thumbnails')
-    for thumbnail_url in all_thumbnail_urls:
-        blob_name = thumbnail_url.split('/')[-1]
-        blob = candidate_thumbnails_bucket.get_blob(blob_name)
-        blob.delete()
+    num_deleted, num_missing = delete_blobs(candidate_thumbnails_bucket, [thumbnail_url.split('/')[-1] for thumbnail_url in all_thumbnail_urls])
+    if num_missing > 0:
+        print(f'\t{num_missing} candidate thumbnails were already deleted')
 
     return True, False, True
 
@@ -455,25 +494,30 @@ class AlienAnswersHitPipeline:
         #                                   image_url='https://www.coloursofistria.com/cms_media/images/ARTICLES/Umag-2015v.jpg',
         #                                   production=self.production, datastore_client=self.datastore_client)
 
-    def create_aa_hit_batch_from_hit_ids(self, hb, hit_ids):
+    def create_aa_hit_batch_from_hit_ids(self, hb, hit_ids, dirty_hit_ids=None):
         hit_batch = create_aa_hit_batch_from_hit_ids(hb, hit_ids, self.submission_id, self.production, update=False)
-        hit_batch.update_results(datastore_client=self.datastore_client)
+        hit_batch.update_results(datastore_client=self.datastore_client, hit_ids=dirty_hit_ids)
         return hit_batch
 
     def archived_datastore_entity(self, hit_entity):
-        return archived_datastore_entity(hit_entity, self.datastore_client)
+        return archived_datastore_entity(encoded_hit_entity_copy(hit_entity), self.datastore_client)
 
     def archive_datastore_entity(self, hit_entity):
         archive_datastore_entity(hit_entity, self.datastore_client)
 
-    def propagate(self):
+    def get_hit_entities(self):
         submission_id_query = self.datastore_client.query(kind='hit')
         submission_id_query.add_filter('submission_id', '=', self.submission_id)
         submission_id_query.add_filter('production', '=', self.production)
-        submission_hit_entities = list(submission_id_query.fetch())
+        return decode_hit_entities(submission_id_query.fetch())
 
-        active_hit_entities = list(filter(lambda e: e['active'], submission_hit_entities))
-        inactive_hit_entities = list(filter(lambda e: not e['active'], submission_hit_entities))
+    def propagate(self, dirty_hit_ids=None, hit_entities=None):
+        # dirty_hit_ids restricts result updates to the hits mturk notified us about, None updates every active hit.
+        # hit_entities is this submission's slice of an orchestrator wide fetch, None queries them here
+        if hit_entities is None:
+            hit_entities = self.get_hit_entities()
+
+        submission_state = SubmissionState(self.submission_id, hit_entities, datastore_client=self.datastore_client)
 
         batch = self.datastore_client.batch()
         with batch:
@@ -487,42 +531,30 @@ class AlienAnswersHitPipeline:
             hit_batch_classes_by_hit_type = {hit_batch_class.hit_type: hit_batch_class for hit_batch_class in hit_batch_classes}
             ##
 
-            hit_ids_by_hit_type = {hit_type: [] for hit_type in hit_batch_classes_by_hit_type.keys()}
-            hit_entities_by_hit_type = {hit_type: [] for hit_type in hit_batch_classes_by_hit_type.keys()}
-
-            for hit_entity in active_hit_entities:
-                hit_id = hit_entity['hit_id']
-                hit_type = hit_entity['hit_type']
-
-                hit_ids_by_hit_type[hit_type].append(hit_id)
-                hit_entities_by_hit_type[hit_type].append(hit_entity)
+            hit_ids_by_hit_type = {hit_type: [hit_entity['hit_id'] for hit_entity in submission_state.get_hit_entities_by_hit_type(hit_type, active=True)]
+                                   for hit_type in hit_batch_classes_by_hit_type.keys()}
 
             # todo: make hit_batches a @dataclass
-            hit_batches = {hit_type: self.create_aa_hit_batch_from_hit_ids(hit_batch_classes_by_hit_type[hit_type], hit_ids) for hit_type, hit_ids in
-                           hit_ids_by_hit_type.items()}
+            hit_batches = {hit_type: self.create_aa_hit_batch_from_hit_ids(hit_batch_classes_by_hit_type[hit_type], hit_ids, dirty_hit_ids=dirty_hit_ids)
+                           for hit_type, hit_ids in hit_ids_by_hit_type.items()}
 
             hit_batches_launched = {hit_type: hit_batch.assignments_launched > 0 for hit_type, hit_batch in hit_batches.items()}
 
-            hit_batches_completed = {hit_type: hit_batch.completed() for hit_type, hit_batch in hit_batches.items()}
+            # the batches were updated on creation (only the dirty hits, if given), so completion is checked without polling every hit again
+            hit_batches_completed = {hit_type: hit_batch.completed(update=False) for hit_type, hit_batch in hit_batches.items()}
 
         batch = self.datastore_client.batch()
         with batch:
             for preconditions in propagation_logic.keys():
                 # print([(hit_batch_class, hit_batches_completed[hit_batch_class.hit_type]) for hit_batch_class in preconditions])
                 if all([hit_batches_completed[hit_batch_class.hit_type] for hit_batch_class in preconditions]):
-                    deactivate, archive, final = propagation_logic[preconditions](hit_batches, active_hit_entities, inactive_hit_entities, self.datastore_client,
-                                                                                  self.production)
+                    deactivate, archive, final = propagation_logic[preconditions](hit_batches, submission_state, self.datastore_client, self.production)
 
                     if final:
                         # delete hit templates
-                        boto_session = boto3.Session(profile_name=MTURK_PROFILE_NAME)
-                        boto_client = boto_session.client(
-                            service_name=MTURK_PROFILE_NAME,
-                            region_name=MTURK_REGION_NAME,
-                            endpoint_url=MTURK_ENVIRONMENTS["production"]['endpoint'] if self.production else MTURK_ENVIRONMENTS["sandbox"]['endpoint'],
-                        )
-
-                        for hit_entity in submission_hit_entities:
+                        boto_client = get_mturk_client(self.production)
+
+                        for hit_entity in submission_state.hit_entities:
                             batch.put(self.archived_datastore_entity(hit_entity))
                             batch.delete(hit_entity.key)
                             boto_client.delete_hit(
@@ -538,29 +570,59 @@ class AlienAnswersHitPipeline:
 
                     if archive:
                         for hit_batch_class in preconditions:
-                            for hit_entity in hit_entities_by_hit_type[hit_batch_class.hit_type]:
+                            for hit_entity in submission_state.get_hit_entities_by_hit_type(hit_batch_class.hit_type, active=True):
                                 batch.put(self.archived_datastore_entity(hit_entity))
                                 batch.delete(hit_entity.key)
                         continue
 
                     if deactivate:
-                        for hit_batch_class in preconditions:
-                            for hit_entity in hit_entities_by_hit_type[hit_batch_class.hit_type]:
-                                current_hit_entity = self.datastore_client.get(hit_entity.key)
-                                current_hit_entity.update(dict(active=False))
-                                batch.put(current_hit_entity)
+                        hit_keys = [hit_entity.key for hit_batch_class in preconditions
+                                    for hit_entity in submission_state.get_hit_entities_by_hit_type(hit_batch_class.hit_type, active=True)]
+                        for current_hit_entity in get_multi(self.datastore_client, hit_keys):
+                            if not current_hit_entity['active']:
+                                continue  # already deactivated, rewriting it would only cost another write of its results
+
+                            current_hit_entity.update(dict(active=False))
+                            batch.put(encode_hit_entity(current_hit_entity))
         pass
 
 
 class AlienAnswersHitPipelineOrchestrator:
-    def __init__(self, production=True, datastore_client=None):
+    def __init__(self, production=True, datastore_client=None, event_consumer=None, prefetch_hit_entities=True, max_workers=PIPELINE_MAX_WORKERS):
         self.production = production
         self.datastore_client = get_datastore_client() if datastore_client is None else datastore_client
 
+        # with an event consumer, mturk notifications decide which submissions get propagated instead of a fixed polling interval.
+        # the orchestrator registers the hit types it sees with its own consumer, see register_hit_types
+        self.event_consumer = event_consumer
+
+        # submission ids per kind, read at most once per step unless the step itself changes the kind
+        self.submission_ids_by_kind = {}
+
+        # with prefetching, the hit entities of all submissions are read in one query per step instead of one query per submission
+        self.prefetch_hit_entities = prefetch_hit_entities
+
+        # submissions are launched and propagated concurrently, a per submission lock keeps two workers off the same submission
+        self.max_workers = max_workers
+        self.submission_locks = {}
+        self.submission_locks_lock = threading.Lock()
+
+        self.scheduler = SubmissionScheduler(assignment_durations={hit_batch_class.hit_type: hit_batch_class.assignment_duration
+                                                                   for preconditions in propagation_logic.keys() for hit_batch_class in preconditions})
+
     def get_submission_ids_from_kind(self, kind):
-        query = self.datastore_client.query(kind=kind)
-        entities = list(query.fetch())
-        return set([e['submission_id'] for e in entities])
+        if kind not in self.submission_ids_by_kind:
+            # a distinct projection only reads the indexed submission_id, not the entities (and their results payloads)
+            query = self.datastore_client.query(kind=kind, projection=['submission_id'], distinct_on=['submission_id'])
+            self.submission_ids_by_kind[kind] = set([e['submission_id'] for e in query.fetch()])
+
+        return set(self.submission_ids_by_kind[kind])
+
+    def invalidate_submission_ids(self, kind=None):
+        if kind is None:
+            self.submission_ids_by_kind = {}
+        else:
+            self.submission_ids_by_kind.pop(kind, None)
 
     def get_selected_post_ids(self):
         return self.get_submission_ids_from_kind(kind='selected_post')
@@ -579,35 +641,110 @@ class AlienAnswersHitPipelineOrchestrator:
         random.shuffle(pipelines)
         return pipelines
 
+    def get_hit_entities_by_submission_id(self):
+        query = self.datastore_client.query(kind='hit')
+        query.add_filter('production', '=', self.production)
+
+        hit_entities_by_submission_id = {}
+        for hit_entity in query.fetch():  # streamed page by page
+            submission_id = hit_entity.get('submission_id')
+            if submission_id is None:  # hits launched outside of a pipeline
+                continue
+            hit_entities_by_submission_id.setdefault(submission_id, []).append(decode_hit_entity(hit_entity))
+
+        if self.event_consumer is not None:
+            self.register_hit_types([hit_entity for hit_entities in hit_entities_by_submission_id.values() for hit_entity in hit_entities])
+
+        return hit_entities_by_submission_id
+
+    def register_hit_types(self, hit_entities):
+        """has mturk notify the event consumer about the hit types of hit_entities, each hit type is only registered once"""
+        boto_client = get_mturk_client(self.production)
+        hit_type_ids = {hit_entity['creation_response']['HIT']['HITTypeId'] for hit_entity in hit_entities if 'creation_response' in hit_entity}
+
+        for hit_type_id in hit_type_ids:
+            self.event_consumer.register_hit_type(boto_client, hit_type_id)
+
     def propagate_ids(self, submission_ids):
         pipelines = self.get_pipelines_for_ids(submission_ids)
-        self.propagate_pipelines(pipelines)
-
-    def propagate_pipelines(self, pipelines):
-        for pipeline in pipelines:
-            print(f'propagating {pipeline.submission_id}')
-            pipeline.propagate()
-            self.print_line()
+        # the event consumer learns about new hit types from the prefetched entities as well
+        prefetch = self.prefetch_hit_entities or self.event_consumer is not None
+        hit_entities_by_submission_id = self.get_hit_entities_by_submission_id() if prefetch else None
+        return self.propagate_pipelines(pipelines, hit_entities_by_submission_id=hit_entities_by_submission_id)
+
+    def propagate_pipelines(self, pipelines, hit_entities_by_submission_id=None):
+        def propagate(pipeline):
+            if hit_entities_by_submission_id is None:
+                pipeline.propagate()
+            else:
+                pipeline.propagate(hit_entities=hit_entities_by_submission_id.get(pipeline.submission_id, []))
+
+        return self.run_pipelines(pipelines, propagate, description='propagating')
+
+    def get_submission_lock(self, submission_id):
+        with self.submission_locks_lock:
+            return self.submission_locks.setdefault(submission_id, threading.Lock())
+
+    def run_pipelines(self, pipelines, action, description):
+        """
+        calls action(pipeline) for every pipeline on up to max_workers threads. a submission that is already being worked on is skipped
+        and a failing submission is reported rather than ending the step. returns the exceptions by submission_id
+        """
+        failures = {}
+
+        def run(pipeline):
+            submission_lock = self.get_submission_lock(pipeline.submission_id)
+            if not submission_lock.acquire(blocking=False):
+                print(f'skipping {pipeline.submission_id}, another worker is on it')
+                return
+
+            try:
+                print(f'{description} {pipeline.submission_id}')
+                action(pipeline)
+            except Exception as e:
+                print(f'{description} {pipeline.submission_id} failed: {e!r}')
+                traceback.print_exc()
+                failures[pipeline.submission_id] = e
+            finally:
+                submission_lock.release()
+                self.print_line()
+
+        if self.max_workers is None or self.max_workers <= 1:
+            for pipeline in pipelines:
+                run(pipeline)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(run, pipelines))
+
+        if len(failures) > 0:
+            print(f'{description} failed for {len(failures)} ids: {", ".join(failures.keys())}')
+
+        return failures
 
     def print_line(self):
         print('-' * 40)
 
     def launch_ids(self, ids):
-        for pipeline in self.get_pipelines_for_ids(ids):
-            print(f'launching {pipeline.submission_id}')
-            pipeline.launch()
-            self.print_line()
+        return self.run_pipelines(self.get_pipelines_for_ids(ids), lambda pipeline: pipeline.launch(), description='launching')
+
+    def launch_new_ids(self):
+        self.invalidate_submission_ids()
 
-    def step(self):
         if self.get_num_video_formulas() < (NUM_ALL_TIME_TOP_POSTS_PER_DAY + NUM_WEEKLY_TOP_POSTS_PER_DAY) * 3:
             if self.get_num_ids_in_pipeline() == 0:
                 print('selecting new posts')
                 select_posts_for_week()
+                self.invalidate_submission_ids(kind='selected_post')
 
         print('launching new ids')
         self.print_line()
         unlaunched_ids = self.get_selected_post_ids() - self.get_ids_in_pipeline()
         self.launch_ids(unlaunched_ids)
+        if len(unlaunched_ids) > 0:
+            self.invalidate_submission_ids(kind='hit')  # the launched ids are in the pipeline now
+
+    def step(self):
+        self.launch_new_ids()
 
         ids_in_pipeline = list(self.get_ids_in_pipeline())
         random.shuffle(ids_in_pipeline)
@@ -626,6 +763,97 @@ class AlienAnswersHitPipelineOrchestrator:
             # tqdm_countdown(secs=60 * 10, description='sleeping')
             print()
 
+    def propagate_due_ids(self):
+        due_ids = self.scheduler.pop_due()
+        if len(due_ids) == 0:
+            return
+
+        print(f'propagating {len(due_ids)} due ids')
+        self.print_line()
+
+        # only the due submissions' entities are read, each by a query filtered on its submission_id, rather than the whole hit kind
+        hit_entities_by_submission_id = {}
+
+        def propagate(pipeline):
+            pipeline.propagate()
+
+            # propagating parses new assignments, launches hits and finalizes submissions, so progress is scheduled from the entities as written
+            hit_entities_by_submission_id[pipeline.submission_id] = pipeline.get_hit_entities()
+
+        failures = self.run_pipelines(self.get_pipelines_for_ids(due_ids), propagate, description='propagating')
+
+        if self.event_consumer is not None:
+            self.register_hit_types([hit_entity for hit_entities in hit_entities_by_submission_id.values() for hit_entity in hit_entities])
+
+        for submission_id in due_ids:
+            if submission_id in failures:
+                self.scheduler.record_failure(submission_id)
+            else:
+                if submission_id in hit_entities_by_submission_id:
+                    self.scheduler.record_check(submission_id, hit_entities_by_submission_id[submission_id])
+                else:  # skipped, another worker was on it
+                    self.scheduler.schedule(submission_id, time.time() + self.scheduler.min_interval)
+
+    def scheduled_loop(self, step_interval=600, max_sleep_duration=60):
+        """
+        checks each submission when the scheduler expects it to have progressed instead of checking all of them every step.
+        new ids are still launched every step_interval seconds and are checked right away
+        """
+        last_step_time = None
+
+        while True:
+            if last_step_time is None or time.monotonic() - last_step_time >= step_interval:
+                self.launch_new_ids()
+                self.scheduler.schedule_new(self.get_ids_in_pipeline())
+                last_step_time = time.monotonic()
+
+            self.propagate_due_ids()
+
+            time_until_next = self.scheduler.time_until_next()
+            time.sleep(max_sleep_duration if time_until_next is None else min(time_until_next, max_sleep_duration))
+
+    def get_dirty_hit_ids_by_submission_id(self, dirty_hit_ids):
+        hit_entities = get_hit_entities(self.datastore_client, dirty_hit_ids)
+
+        dirty_hit_ids_by_submission_id = {}
+        for hit_entity in hit_entities.values():
+            dirty_hit_ids_by_submission_id.setdefault(hit_entity['submission_id'], set()).add(hit_entity['hit_id'])
+
+        return dirty_hit_ids_by_submission_id
+
+    def propagate_dirty_hits(self):
+        dirty_hit_ids = self.event_consumer.pop_dirty_hit_ids()
+        if len(dirty_hit_ids) == 0:
+            return
+
+        dirty_hit_ids_by_submission_id = self.get_dirty_hit_ids_by_submission_id(dirty_hit_ids)
+
+        print(f'propagating {len(dirty_hit_ids_by_submission_id)} ids with {len(dirty_hit_ids)} notified hits')
+        self.print_line()
+
+        pipelines = self.get_pipelines_for_ids(dirty_hit_ids_by_submission_id.keys())
+        failures = self.run_pipelines(pipelines, lambda pipeline: pipeline.propagate(dirty_hit_ids=dirty_hit_ids_by_submission_id[pipeline.submission_id]),
+                                      description='propagating')
+
+        # failed submissions stay dirty, so they are retried on the next poll
+        if len(failures) > 0:
+            self.event_consumer.mark_dirty(hit_id for submission_id in failures for hit_id in dirty_hit_ids_by_submission_id[submission_id])
+
+    def event_loop(self, step_interval=600, wait_time=20):
+        """
+        propagates submissions as soon as mturk notifies us about their hits. a full step still runs every step_interval seconds,
+        to launch new ids and to pick up anything a lost notification would have missed
+        """
+        last_step_time = None
+
+        while True:
+            if last_step_time is None or time.monotonic() - last_step_time >= step_interval:
+                self.step()
+                last_step_time = time.monotonic()
+
+            self.event_consumer.poll(wait_time=wait_time)
+            self.propagate_dirty_hits()
+
 
 if __name__ == "__main__":
     # dc = get_datastore_client()
@@ -636,7 +864,9 @@ if __name__ == "__main__":
     # u = 'https://encrypted-tbn0.gstatic.com/images?q=tbn:ANd9GcQp9RDt3dlUL4OAegbpTr0lSU3P61_LcavmYN_lPbZVCaSkQw_1&s'
     # print()
 
-    AlienAnswersHitPipelineOrchestrator().loop()
+    preload_templates()  # compile every hit template once up front instead of on the first launch of each hit type
+    get_render_pool()  # the thumbnail render pool lives as long as the orchestrator
+    AlienAnswersHitPipelineOrchestrator().scheduled_loop()
 
     # ids = ['dcepx9', 'dcduwk', '5ipinn', '55ng8w', '348vlx', '2vpng7', '2np694']
     # ids = get_selected_post_ids()
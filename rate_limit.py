@@ -0,0 +1,187 @@
+import collections
+import random
+import threading
+import time
+
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+from config import MTURK_DEFAULT_RATE_LIMIT, MTURK_OPERATION_RATE_LIMITS, MTURK_MAX_RATE_LIMIT, MTURK_MAX_THROTTLING_RETRIES
+
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded', 'ServiceUnavailable'}
+
+
+def get_error_response(e):
+    # botocore errors without a service response (e.g. connection errors) may carry response=None
+    return getattr(e, 'response', None) or dict()
+
+
+def is_throttling_error(e):
+    error = get_error_response(e).get('Error') or dict()
+    message = (error.get('Message') or '').lower()
+    return error.get('Code') in THROTTLING_ERROR_CODES or ('rate' in message and 'exceed' in message)
+
+
+def is_transient_error(e):
+    """connection problems and server errors, which are worth retrying but say nothing about the request rate"""
+    if isinstance(e, (ConnectionError, HTTPClientError)):
+        return True
+
+    status_code = (get_error_response(e).get('ResponseMetadata') or dict()).get('HTTPStatusCode')
+    return status_code is not None and status_code >= 500
+
+
+class AdaptiveTokenBucket:
+    """
+    token bucket whose refill rate follows aimd: starting at rate, it grows additively on every successful call up to max_rate
+    (probing for the actual limit) and is cut multiplicatively whenever a call is throttled. bursts are limited to one second's worth of tokens
+    """
+
+    def __init__(self, rate, max_rate=None, min_rate=0.2, additive_increase=0.1, multiplicative_decrease=0.5, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = rate if max_rate is None else max(rate, max_rate)
+        self.min_rate = min(min_rate, rate)
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.clock = clock
+        self.sleep = sleep
+
+        self.rate = rate
+        self.tokens = self.get_capacity()
+        self.updated = self.clock()
+        self.lock = threading.Lock()
+
+    def get_capacity(self):
+        return max(1, self.rate)
+
+    def acquire(self):
+        """takes a token, sleeping until it is available. returns the number of seconds waited"""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.get_capacity(), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # tokens may go negative, which reserves a slot in the future for this caller
+            self.tokens -= 1
+            wait_duration = 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+        if wait_duration > 0:
+            self.sleep(wait_duration)
+
+        return wait_duration
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.additive_increase)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.multiplicative_decrease)
+            self.tokens = min(self.tokens, 0)
+
+
+class OperationStats:
+    def __init__(self):
+        self.num_calls = 0
+        self.num_throttled = 0
+        self.num_transient_errors = 0
+        self.num_retries = 0
+        self.wait_duration = 0
+        self.max_wait_duration = 0
+
+    def as_dict(self):
+        return dict(
+            num_calls=self.num_calls,
+            num_throttled=self.num_throttled,
+            num_transient_errors=self.num_transient_errors,
+            num_retries=self.num_retries,
+            wait_duration=self.wait_duration,
+            max_wait_duration=self.max_wait_duration,
+        )
+
+
+class AdaptiveRateLimiter:
+    """
+    shares one adaptive token bucket per operation between all threads and retries throttled calls with jittered exponential backoff.
+    botocore's own retries are turned off (see clients.py) so that throttling reaches the buckets, which is why connection and server errors
+    are retried here as well, with the same backoff but without lowering the rate
+    """
+
+    def __init__(self, operation_rate_limits=None, default_rate_limit=MTURK_DEFAULT_RATE_LIMIT, max_rate_limit=MTURK_MAX_RATE_LIMIT,
+                 max_retries=MTURK_MAX_THROTTLING_RETRIES, base_retry_delay=0.5, max_retry_delay=30, clock=time.monotonic, sleep=time.sleep):
+        self.operation_rate_limits = MTURK_OPERATION_RATE_LIMITS if operation_rate_limits is None else operation_rate_limits
+        self.default_rate_limit = default_rate_limit
+        self.max_rate_limit = max_rate_limit
+        self.max_rate_limits = dict()  # operation -> ceiling overriding max_rate_limit, see set_max_rate
+        self.max_retries = max_retries
+        self.base_retry_delay = base_retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+        self.sleep = sleep
+
+        self.buckets = dict()
+        self.operation_stats = collections.defaultdict(OperationStats)
+        self.lock = threading.Lock()
+
+    def get_bucket(self, operation):
+        with self.lock:
+            if operation not in self.buckets:
+                self.buckets[operation] = AdaptiveTokenBucket(self.operation_rate_limits.get(operation, self.default_rate_limit),
+                                                              max_rate=self.max_rate_limits.get(operation, self.max_rate_limit),
+                                                              clock=self.clock, sleep=self.sleep)
+            return self.buckets[operation]
+
+    def set_max_rate(self, operation, max_rate):
+        """overrides the ceiling the rate of operation may grow to, e.g. for a large launch with a raised mturk limit"""
+        bucket = self.get_bucket(operation)
+
+        with self.lock:
+            self.max_rate_limits[operation] = max_rate
+
+        with bucket.lock:
+            bucket.max_rate = max_rate
+            bucket.rate = min(bucket.rate, max_rate)
+
+    def call(self, operation, func, *args, **kwargs):
+        bucket = self.get_bucket(operation)
+
+        attempt = 0
+        while True:
+            wait_duration = bucket.acquire()
+
+            with self.lock:
+                stats = self.operation_stats[operation]
+                stats.num_calls += 1
+                stats.wait_duration += wait_duration
+                stats.max_wait_duration = max(stats.max_wait_duration, wait_duration)
+
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    bucket.on_throttle()
+
+                    with self.lock:
+                        stats.num_throttled += 1
+                elif is_transient_error(e):
+                    with self.lock:
+                        stats.num_transient_errors += 1
+                else:
+                    raise
+
+                if attempt >= self.max_retries:
+                    raise
+
+                retry_delay = random.uniform(0, min(self.max_retry_delay, self.base_retry_delay * 2 ** attempt))  # full jitter
+                with self.lock:
+                    stats.num_retries += 1
+                    stats.wait_duration += retry_delay
+
+                self.sleep(retry_delay)
+                attempt += 1
+                continue
+
+            bucket.on_success()
+            return response
+
+    def stats(self):
+        with self.lock:
+            return {operation: stats.as_dict() for operation, stats in self.operation_stats.items()}
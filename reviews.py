@@ -0,0 +1,118 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from config import REVIEW_MAX_WORKERS, REVIEW_MAX_ATTEMPTS
+
+ReviewDecision = collections.namedtuple('ReviewDecision', 'assignment_id approve requester_feedback')
+ReviewFailure = collections.namedtuple('ReviewFailure', 'decision exception')
+
+# one pool reviews for every hit in the process, the queues only keep track of their own reviews
+_review_executor = ThreadPoolExecutor(max_workers=REVIEW_MAX_WORKERS)
+
+# the assignments whose review failed for good, by hit id. they are picked up by the next poll of the hit (see Hit.collect_review_failures),
+# which may be done by another hit batch than the one that queued the review
+_failed_review_assignment_ids = collections.defaultdict(set)
+_failed_review_assignment_ids_lock = threading.Lock()
+
+
+def pop_failed_review_assignment_ids(hit_id):
+    with _failed_review_assignment_ids_lock:
+        return _failed_review_assignment_ids.pop(hit_id, set())
+
+
+class ReviewQueue:
+    """
+    approves and rejects assignments in the background with a bounded pool of workers, so that parsing results never waits on a review.
+    failed calls are retried and a review counts as done once the assignment has reached the decided status, even if it was reviewed before.
+    reviews that still fail are collected until the next join, are recorded by hit id for the next poll of the hit
+    and their assignments may be submitted again
+    """
+
+    def __init__(self, boto_client, executor=None, max_attempts=REVIEW_MAX_ATTEMPTS, retry_delay=1):
+        self.boto_client = boto_client
+        self.executor = _review_executor if executor is None else executor
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        self.futures = []
+        self.submitted_assignment_ids = set()
+        self.reviewed_assignment_ids = set()  # reviewed since the last pop_reviewed_assignment_ids
+        self.failures = []
+        self.lock = threading.Lock()
+
+    def submit(self, assignment_id, answer_report, hit_id=None):
+        decision = ReviewDecision(assignment_id, answer_report.deemed_acceptable, answer_report.requester_feedback)
+
+        with self.lock:
+            if assignment_id in self.submitted_assignment_ids:
+                return
+
+            self.submitted_assignment_ids.add(assignment_id)
+            self.futures.append(self.executor.submit(self.review, decision, hit_id))
+
+    def review(self, decision, hit_id=None):
+        for attempt in range(self.max_attempts):
+            try:
+                if decision.approve:
+                    self.boto_client.approve_assignment(
+                        AssignmentId=decision.assignment_id,
+                        OverrideRejection=False
+                    )
+                else:
+                    self.boto_client.reject_assignment(
+                        AssignmentId=decision.assignment_id,
+                        RequesterFeedback=decision.requester_feedback
+                    )
+                self.mark_reviewed(decision)
+                return
+            except Exception as e:
+                if self.already_reviewed(decision):
+                    self.mark_reviewed(decision)
+                    return
+
+                if attempt == self.max_attempts - 1:
+                    with self.lock:
+                        self.failures.append(ReviewFailure(decision, e))
+                        self.submitted_assignment_ids.discard(decision.assignment_id)
+                    if hit_id is not None:
+                        with _failed_review_assignment_ids_lock:
+                            _failed_review_assignment_ids[hit_id].add(decision.assignment_id)
+                    print(f'could not review assignment {decision.assignment_id}: {e}')
+                    return
+
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def mark_reviewed(self, decision):
+        with self.lock:
+            self.reviewed_assignment_ids.add(decision.assignment_id)
+
+    def pop_reviewed_assignment_ids(self):
+        with self.lock:
+            reviewed_assignment_ids = self.reviewed_assignment_ids
+            self.reviewed_assignment_ids = set()
+
+        return reviewed_assignment_ids
+
+    def already_reviewed(self, decision):
+        try:
+            status = self.boto_client.get_assignment(AssignmentId=decision.assignment_id)['Assignment']['AssignmentStatus']
+        except Exception:
+            return False
+
+        return status == ('Approved' if decision.approve else 'Rejected')
+
+    def join(self):
+        """blocks until every submitted review is done and returns the reviews that failed since the last join"""
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+
+        wait(futures)
+
+        with self.lock:
+            failures = self.failures
+            self.failures = []
+
+        return failures
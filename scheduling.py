@@ -0,0 +1,158 @@
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+from config import SCHEDULER_MIN_CHECK_INTERVAL, SCHEDULER_MAX_CHECK_INTERVAL, SCHEDULER_BACKOFF_FACTOR, SCHEDULER_DEFAULT_PICKUP_LATENCY, \
+    SCHEDULER_PICKUP_LATENCY_SMOOTHING
+
+
+def to_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:  # mturk and datastore times are utc
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    if isinstance(value, str):
+        return to_timestamp(datetime.datetime.fromisoformat(value))
+    return value
+
+
+class SubmissionScheduler:
+    """
+    decides when each submission is checked next, using a priority queue keyed by due time.
+    a submission with outstanding hits is due once its earliest hit can be expected to have an assignment submitted
+    (creation time + pickup latency + assignment duration of its hit type). checks that find nothing new back off the interval,
+    checks that find progress reset it
+    """
+
+    def __init__(self, assignment_durations, min_interval=SCHEDULER_MIN_CHECK_INTERVAL, max_interval=SCHEDULER_MAX_CHECK_INTERVAL,
+                 backoff_factor=SCHEDULER_BACKOFF_FACTOR, default_pickup_latency=SCHEDULER_DEFAULT_PICKUP_LATENCY,
+                 smoothing=SCHEDULER_PICKUP_LATENCY_SMOOTHING):
+        self.assignment_durations = assignment_durations  # hit type -> assignment duration in seconds
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.default_pickup_latency = default_pickup_latency
+        self.smoothing = smoothing
+
+        self.queue = []  # (due time, sequence number, submission id), entries superseded by a later schedule call are skipped when popped
+        self.due_times = dict()
+        self.sequence = itertools.count()
+        self.backoffs = dict()  # submission id -> current backoff multiplier
+        self.progress = dict()  # submission id -> (hit ids, assignments completed) seen on the last check
+        self.pickup_latencies = dict()  # hit type -> smoothed pickup latency in seconds
+        self.completed_hit_ids = set()  # hits whose first submitted assignment was already used as a latency observation
+        self.lock = threading.Lock()
+
+    def schedule(self, submission_id, due_time):
+        with self.lock:
+            self.due_times[submission_id] = due_time
+            heapq.heappush(self.queue, (due_time, next(self.sequence), submission_id))
+
+    def schedule_new(self, submission_ids, due_time=None):
+        """schedules the submissions that are not scheduled yet, by default right away"""
+        due_time = time.time() if due_time is None else due_time
+        for submission_id in submission_ids:
+            if submission_id not in self.due_times:
+                self.schedule(submission_id, due_time)
+
+    def unschedule(self, submission_id):
+        with self.lock:
+            self.due_times.pop(submission_id, None)
+            self.backoffs.pop(submission_id, None)
+            self.progress.pop(submission_id, None)
+
+    def pop_due(self, now=None):
+        now = time.time() if now is None else now
+        due_submission_ids = []
+
+        with self.lock:
+            while len(self.queue) > 0 and self.queue[0][0] <= now:
+                due_time, _, submission_id = heapq.heappop(self.queue)
+                if self.due_times.get(submission_id) == due_time:
+                    del self.due_times[submission_id]
+                    due_submission_ids.append(submission_id)
+
+        return due_submission_ids
+
+    def time_until_next(self, now=None):
+        now = time.time() if now is None else now
+
+        with self.lock:
+            while len(self.queue) > 0 and self.due_times.get(self.queue[0][2]) != self.queue[0][0]:
+                heapq.heappop(self.queue)
+
+            if len(self.queue) == 0:
+                return None
+            return max(self.queue[0][0] - now, 0)
+
+    def get_pickup_latency(self, hit_type):
+        return self.pickup_latencies.get(hit_type, self.default_pickup_latency)
+
+    def observe_pickup_latencies(self, hit_entities):
+        # the first time a hit shows a submitted assignment, the time from its creation to that submission minus the time workers get
+        # for it is taken as how long the hit type waits to be picked up. hits stored without a submission time are not observed
+        for hit_entity in hit_entities:
+            if hit_entity['hit_id'] in self.completed_hit_ids or hit_entity.get('first_submission_time') is None:
+                continue
+            self.completed_hit_ids.add(hit_entity['hit_id'])
+
+            hit_type = hit_entity.get('hit_type')
+            latency = to_timestamp(hit_entity['first_submission_time']) - to_timestamp(hit_entity['creation_time']) - \
+                self.assignment_durations.get(hit_type, 0)
+            latency = max(latency, 0)
+
+            previous_latency = self.get_pickup_latency(hit_type)
+            self.pickup_latencies[hit_type] = (1 - self.smoothing) * previous_latency + self.smoothing * latency
+
+    def get_expected_interval(self, hit_entities, now):
+        outstanding_hit_entities = [hit_entity for hit_entity in hit_entities if
+                                    hit_entity['active'] and hit_entity.get('assignments_completed', 0) < hit_entity.get('assignments_launched', 1)]
+
+        if len(outstanding_hit_entities) == 0:
+            return self.min_interval  # everything is in, the next stage can be propagated (or was just launched)
+
+        expected_times = [
+            to_timestamp(hit_entity['creation_time']) + self.get_pickup_latency(hit_entity.get('hit_type')) +
+            self.assignment_durations.get(hit_entity.get('hit_type'), 0)
+            for hit_entity in outstanding_hit_entities
+        ]
+        return min(expected_times) - now
+
+    def record_check(self, submission_id, hit_entities, now=None):
+        """schedules the next check of a submission that was just checked, hit_entities are its hit entities as seen by the check"""
+        now = time.time() if now is None else now
+
+        if len(hit_entities) == 0:
+            self.unschedule(submission_id)  # finalized, or never launched
+            return None
+
+        progress = (frozenset(hit_entity['hit_id'] for hit_entity in hit_entities),
+                    sum(hit_entity.get('assignments_completed', 0) for hit_entity in hit_entities))
+
+        with self.lock:
+            self.observe_pickup_latencies(hit_entities)
+
+            if self.progress.get(submission_id) == progress:
+                backoff = self.backoffs.get(submission_id, 1) * self.backoff_factor
+            else:
+                backoff = 1
+            self.backoffs[submission_id] = backoff
+            self.progress[submission_id] = progress
+
+            interval = max(self.get_expected_interval(hit_entities, now), self.min_interval) * backoff
+
+        interval = min(interval, self.max_interval)
+        self.schedule(submission_id, now + interval)
+
+        return interval
+
+    def record_failure(self, submission_id, now=None):
+        now = time.time() if now is None else now
+
+        with self.lock:
+            backoff = self.backoffs.get(submission_id, 1) * self.backoff_factor
+            self.backoffs[submission_id] = backoff
+
+        self.schedule(submission_id, now + min(self.min_interval * backoff, self.max_interval))
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import NotFound
+
+from config import STORAGE_MAX_WORKERS
+
+
+def run_blob_operations(operation, blob_names, max_workers=STORAGE_MAX_WORKERS):
+    """
+    calls operation(blob_name) for every blob name concurrently. missing blobs are counted instead of failing,
+    any other error is raised once every operation has been attempted. returns the number of blobs found and missing
+    """
+    blob_names = list(dict.fromkeys(blob_names))
+
+    def run(blob_name):
+        try:
+            operation(blob_name)
+            return True, None
+        except NotFound:
+            return False, None
+        except Exception as e:
+            return False, e
+
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(blob_names)), 1)) as executor:
+        outcomes = list(executor.map(run, blob_names))
+
+    errors = [e for _, e in outcomes if e is not None]
+    if len(errors) > 0:
+        print(f'\t{len(errors)} of {len(blob_names)} blob operations failed')
+        raise errors[0]
+
+    num_found = sum(found for found, _ in outcomes)
+    return num_found, len(blob_names) - num_found
+
+
+def delete_blobs(bucket, blob_names, max_workers=STORAGE_MAX_WORKERS):
+    """deletes the blobs by name in one request each (no lookup first), a blob that is already gone counts as deleted"""
+    return run_blob_operations(bucket.delete_blob, blob_names, max_workers=max_workers)
+
+
+def publish_blobs(bucket, blob_names, max_workers=STORAGE_MAX_WORKERS):
+    return run_blob_operations(lambda blob_name: bucket.blob(blob_name).make_public(), blob_names, max_workers=max_workers)
+
+
+def upload_public_blob(bucket, blob_name, data, content_type=None):
+    """uploads data and makes it public in the same request, returns the public url"""
+    blob = bucket.blob(blob_name)
+    blob.upload_from_string(data, content_type=content_type, predefined_acl='publicRead')
+    return blob.public_url
@@ -0,0 +1,90 @@
+import functools
+import glob
+import os
+import re
+import threading
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from config import QUESTION_XML
+from utils import strip_non_ascii
+
+PLACEHOLDER_PATTERN = re.compile(r'\$\{([^}]*)\}')
+TEMPLATE_STRIPPED_CHARACTERS_KEY = '<template>'  # reports characters stripped from the template itself rather than from a param
+
+
+class CompiledTemplate:
+    def __init__(self, source, mtime=None):
+        # splitting on the capturing pattern leaves literal text at even and placeholder names at odd indices
+        self.parts = PLACEHOLDER_PATTERN.split(source)
+        self.mtime = mtime
+
+        # the literal text never changes, so it is stripped of non ascii characters once here instead of on every render
+        self.stripped_characters = ''
+        for i in range(0, len(self.parts), 2):
+            self.parts[i], stripped_characters = strip_non_ascii(self.parts[i])
+            self.stripped_characters += stripped_characters
+
+    def render(self, params):
+        parts = self.parts.copy()
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = params[name] if name in params else f'${{{name}}}'  # unknown placeholders are left untouched
+
+        return ''.join(parts)
+
+
+class TemplateCache:
+    """
+    compiles ${param} style hit templates, wrapped in the question xml, once per file and recompiles them when the file's mtime changes
+    """
+
+    def __init__(self, wrapper=QUESTION_XML):
+        self.wrapper = wrapper
+        self.compiled_templates = dict()
+        self.lock = threading.Lock()
+
+    def get(self, template_location):
+        mtime = os.stat(template_location).st_mtime
+
+        compiled_template = self.compiled_templates.get(template_location)
+        if compiled_template is not None and compiled_template.mtime == mtime:
+            return compiled_template
+
+        with open(template_location, 'r') as f:
+            html_layout = f.read()
+
+        compiled_template = CompiledTemplate(self.wrapper.format(html_layout), mtime=mtime)
+
+        with self.lock:
+            self.compiled_templates[template_location] = compiled_template
+
+        return compiled_template
+
+    def render(self, template_location, params):
+        return self.get(template_location).render(params)
+
+    def preload(self, templates_folder, pattern='*.html'):
+        for template_location in glob.glob(os.path.join(templates_folder, pattern)):
+            self.get(template_location)
+
+
+template_cache = TemplateCache()
+
+
+@functools.lru_cache(maxsize=None)
+def get_jinja_environment(templates_folder):
+    # jinja keeps compiled templates per environment and, with auto_reload, recompiles them when their mtime changes
+    return Environment(
+        loader=FileSystemLoader(templates_folder),
+        autoescape=select_autoescape(['html']),
+        auto_reload=True,
+    )
+
+
+def preload_templates(templates_folder='hit templates', jinja_template_filenames=('word emphasis hit.html',)):
+    template_cache.preload(templates_folder)
+
+    jinja_environment = get_jinja_environment(templates_folder)
+    for template_filename in jinja_template_filenames:
+        jinja_environment.get_template(template_filename)
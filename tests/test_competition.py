@@ -0,0 +1,39 @@
+import itertools
+
+import pytest
+
+pytest.importorskip('trueskill')
+
+import competition  # noqa: E402
+
+
+@pytest.mark.parametrize('n', range(0, 8))
+def test_unrank_combination_matches_itertools(n):
+    for r in range(0, n + 1):
+        combinations = list(itertools.combinations(range(n), r))
+
+        assert [competition.unrank_combination(index, n, r) for index in range(len(combinations))] == combinations
+
+
+def test_matchups_are_distinct_within_a_cycle():
+    comp = competition.CompetitionFFAWTA(match_size=3)
+    comp.add_contestants_by_ids([str(i) for i in range(6)])
+    num_possible_matchups = comp.get_num_possible_matchups()
+
+    matchups = comp.get_matchups(num_matchups=num_possible_matchups + 5)
+
+    assert len(matchups) == num_possible_matchups + 5
+    assert all(len(set(matchup)) == 3 for matchup in matchups)
+
+    # the first cycle uses every possible matchup exactly once, the next one starts over
+    first_cycle = [frozenset(matchup) for matchup in matchups[:num_possible_matchups]]
+    assert len(set(first_cycle)) == num_possible_matchups
+    assert len({frozenset(matchup) for matchup in matchups[num_possible_matchups:]}) == 5
+
+
+def test_matchups_need_enough_contestants():
+    comp = competition.CompetitionFFAWTA(match_size=3)
+    comp.add_contestants_by_ids(['a', 'b'])
+
+    with pytest.raises(ValueError):
+        comp.get_matchups(num_matchups=1)
@@ -0,0 +1,55 @@
+import datetime
+
+import pytest
+
+from compression import PropertyCodec, zstandard, is_encoded, encode_entity_properties, decode_entity_properties
+
+VALUE = dict(HIT=dict(HITId='3ABC', Keywords=['a', 'b'], MaxAssignments=3, Reward='0.10'), results=[{'worker_id': 'w', 'answer': 'é' * 100}])
+
+ALGORITHMS = ['zlib'] + ([] if zstandard is None else ['zstd'])
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_codec_round_trips_json_values(algorithm):
+    codec = PropertyCodec(algorithm=algorithm)
+
+    encoded = codec.encode(VALUE)
+
+    assert is_encoded(encoded)
+    assert len(encoded) < len(repr(VALUE))
+    assert codec.decode(encoded) == VALUE
+
+
+def test_any_codec_decodes_any_algorithm():
+    for algorithm in ALGORITHMS:
+        assert PropertyCodec().decode(PropertyCodec(algorithm=algorithm).encode(VALUE)) == VALUE
+
+
+def test_unencoded_values_are_decoded_as_they_are():
+    codec = PropertyCodec()
+
+    for value in [VALUE, 'text', b'bytes', 3, None]:
+        assert codec.decode(value) == value
+
+
+def test_datetimes_are_decoded_as_iso_strings():
+    creation_time = datetime.datetime(2026, 1, 1, 12, 30, tzinfo=datetime.timezone.utc)
+
+    assert PropertyCodec().decode(PropertyCodec().encode(dict(CreationTime=creation_time))) == dict(CreationTime=creation_time.isoformat())
+
+
+def test_unknown_algorithms_are_rejected():
+    with pytest.raises(ValueError):
+        PropertyCodec(algorithm='lz4')
+
+
+def test_entity_properties_are_encoded_once_and_decoded_in_place():
+    entity = dict(hit_id='h0', creation_response=VALUE, active=True)
+
+    encode_entity_properties(entity, ['creation_response', 'missing'])
+    encoded = entity['creation_response']
+    encode_entity_properties(entity, ['creation_response'])
+
+    assert is_encoded(encoded) and entity['creation_response'] is encoded
+    assert entity['active'] is True
+    assert decode_entity_properties(entity, ['creation_response', 'missing']) == dict(hit_id='h0', creation_response=VALUE, active=True)
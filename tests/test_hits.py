@@ -0,0 +1,28 @@
+import pytest
+
+# only the third party dependencies are optional here, an import error in hits itself fails the tests
+for module_name in ('boto3', 'botocore', 'xmltodict', 'tqdm', 'jinja2', 'google.cloud.datastore'):
+    pytest.importorskip(module_name)
+
+import hits  # noqa: E402
+
+
+class FakeMTurkClient:
+    pass
+
+
+def test_preexisting_hit_builds_in_production(monkeypatch):
+    # preexisting hits are only polled, so the mandatory task attributes of launched hits must not be required of them
+    monkeypatch.setattr(hits, 'get_mturk_client', lambda production=False: FakeMTurkClient())
+
+    phb = hits.PreexistingHit(hit_ids=['hit id'], production=True, update=False)
+
+    assert phb.production
+    assert phb.hit_ids == ['hit id']
+
+
+def test_launched_hit_validates_task_attributes_in_production(monkeypatch):
+    monkeypatch.setattr(hits, 'get_mturk_client', lambda production=False: FakeMTurkClient())
+
+    with pytest.raises(RuntimeError):
+        hits.AnswerQuestionHit(production=True)
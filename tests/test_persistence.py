@@ -0,0 +1,77 @@
+import copy
+
+import pytest
+
+pytest.importorskip('google.cloud.datastore')
+
+from google.cloud import datastore  # noqa: E402
+
+from persistence import DirtyTracker, save_launched_instances, HIT_PROPERTIES_NOT_STORED  # noqa: E402
+
+
+class FakeDatastoreClient:
+    def __init__(self):
+        self.entities = dict()
+        self.num_puts = 0
+
+    def key(self, *path):
+        return datastore.Key(*path, project='test')
+
+    def get_multi(self, keys):
+        return [copy.deepcopy(self.entities[key]) for key in keys if key in self.entities]
+
+    def put_multi(self, entities):
+        self.num_puts += 1
+        for entity in entities:
+            self.entities[entity.key] = copy.deepcopy(entity)
+
+
+def launched_instance(hit_id, **properties):
+    return dict(dict(hit_id=hit_id, active=True, assignments_completed=0, assignment_ids_parsed=[], results=[]), **properties)
+
+
+def test_dirty_tracker_reports_changed_properties_only():
+    tracker = DirtyTracker(ignored_properties=HIT_PROPERTIES_NOT_STORED)
+    record = launched_instance('h0')
+
+    assert tracker.changed_properties(record) == {'hit_id', 'active', 'assignments_completed', 'assignment_ids_parsed'}
+
+    tracker.mark_clean(record)
+    assert tracker.changed_properties(record) == set()
+
+    record['assignment_ids_parsed'].append('a0')  # in place changes count as well
+    record['assignments_completed'] = 1
+    record['results'].append(dict(answer='ignored'))
+    assert tracker.changed_properties(record) == {'assignment_ids_parsed', 'assignments_completed'}
+
+
+def test_unchanged_launched_instances_are_not_written_again():
+    client = FakeDatastoreClient()
+    tracker = DirtyTracker(ignored_properties=HIT_PROPERTIES_NOT_STORED)
+    launched_instances = [launched_instance('h0'), launched_instance('h1')]
+
+    save_launched_instances(client, launched_instances, dirty_tracker=tracker)
+    save_launched_instances(client, launched_instances, dirty_tracker=tracker)
+
+    assert client.num_puts == 1
+    assert tracker.num_writes == 2
+    assert tracker.num_skipped_writes == 2
+    assert all('results' not in entity for entity in client.entities.values())
+
+
+def test_only_changed_properties_are_merged_into_stored_entities():
+    client = FakeDatastoreClient()
+    tracker = DirtyTracker(ignored_properties=HIT_PROPERTIES_NOT_STORED)
+    record = launched_instance('h0')
+    save_launched_instances(client, [record], dirty_tracker=tracker)
+
+    # another writer sets a property this batch never read
+    client.entities[client.key('hit', 'h0')]['submission_id'] = 'abc'
+
+    record['assignments_completed'] = 1
+    save_launched_instances(client, [record], dirty_tracker=tracker)
+
+    stored = client.entities[client.key('hit', 'h0')]
+    assert stored['assignments_completed'] == 1
+    assert stored['submission_id'] == 'abc'
+    assert client.num_puts == 2
@@ -0,0 +1,106 @@
+import pytest
+
+pytest.importorskip('botocore')
+
+from botocore.exceptions import ClientError, EndpointConnectionError  # noqa: E402
+
+import rate_limit  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self.now += duration
+
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'CreateHIT')
+
+
+def make_limiter(clock, rate=4, max_rate=8):
+    return rate_limit.AdaptiveRateLimiter(operation_rate_limits={'create_hit': rate}, max_rate_limit=max_rate, clock=clock, sleep=clock.sleep)
+
+
+def failing(errors, response='ok'):
+    errors = list(errors)
+
+    def func():
+        if len(errors) > 0:
+            raise errors.pop(0)
+        return response
+
+    return func
+
+
+def test_throttling_cuts_the_rate_multiplicatively():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+    bucket = limiter.get_bucket('create_hit')
+
+    assert limiter.call('create_hit', failing([throttling_error(), throttling_error()])) == 'ok'
+
+    assert bucket.rate == pytest.approx(4 * 0.5 * 0.5 + bucket.additive_increase)
+    assert limiter.stats()['create_hit']['num_throttled'] == 2
+    assert limiter.stats()['create_hit']['num_retries'] == 2
+
+
+def test_rate_grows_additively_up_to_max_rate():
+    clock = FakeClock()
+    bucket = rate_limit.AdaptiveTokenBucket(1, max_rate=1.25, additive_increase=0.1, clock=clock, sleep=clock.sleep)
+
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(1.1)
+
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == 1.25
+
+
+def test_tokens_are_refilled_at_the_current_rate():
+    clock = FakeClock()
+    bucket = rate_limit.AdaptiveTokenBucket(2, clock=clock, sleep=clock.sleep)
+
+    # a full bucket allows a burst of one second's worth of calls, the next call waits for its token
+    assert [bucket.acquire() for _ in range(2)] == [0, 0]
+    assert bucket.acquire() == pytest.approx(0.5)
+
+
+def test_transient_errors_are_retried_without_lowering_the_rate():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+
+    assert limiter.call('create_hit', failing([EndpointConnectionError(endpoint_url='https://mturk')])) == 'ok'
+
+    assert limiter.get_bucket('create_hit').rate == pytest.approx(4 + limiter.get_bucket('create_hit').additive_increase)
+    assert limiter.stats()['create_hit']['num_transient_errors'] == 1
+
+
+def test_non_retryable_errors_are_raised():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+    error = ClientError({'Error': {'Code': 'RequestError', 'Message': 'invalid parameter'}}, 'CreateHIT')
+
+    with pytest.raises(ClientError):
+        limiter.call('create_hit', failing([error]))
+
+    assert limiter.stats()['create_hit']['num_retries'] == 0
+    assert clock.sleeps == []
+    assert limiter.get_bucket('create_hit').rate == 4
+
+
+def test_retries_give_up_after_max_retries():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+    limiter.max_retries = 2
+
+    with pytest.raises(ClientError):
+        limiter.call('create_hit', failing([throttling_error() for _ in range(3)]))
+
+    assert limiter.stats()['create_hit']['num_calls'] == 3
@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+
+from scheduling import SubmissionScheduler, to_timestamp
+
+START = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def hit_entity(hit_id, hit_type='video title', created_after=0, submitted_after=None, assignments_completed=0, assignments_launched=1, active=True):
+    return dict(
+        hit_id=hit_id,
+        hit_type=hit_type,
+        active=active,
+        creation_time=START + datetime.timedelta(seconds=created_after),
+        first_submission_time=None if submitted_after is None else START + datetime.timedelta(seconds=submitted_after),
+        assignments_completed=assignments_completed,
+        assignments_launched=assignments_launched,
+    )
+
+
+def make_scheduler(**kwargs):
+    kwargs = dict(dict(min_interval=30, max_interval=3600, backoff_factor=2, default_pickup_latency=300, smoothing=0.5), **kwargs)
+    return SubmissionScheduler({'video title': 600}, **kwargs)
+
+
+def test_submissions_are_popped_in_due_time_order():
+    scheduler = make_scheduler()
+    scheduler.schedule('late', 300)
+    scheduler.schedule('early', 100)
+    scheduler.schedule('middle', 200)
+
+    assert scheduler.pop_due(now=50) == []
+    assert scheduler.time_until_next(now=50) == 50
+    assert scheduler.pop_due(now=250) == ['early', 'middle']
+    assert scheduler.pop_due(now=1000) == ['late']
+    assert scheduler.time_until_next(now=1000) is None
+
+
+def test_rescheduling_supersedes_the_earlier_due_time():
+    scheduler = make_scheduler()
+    scheduler.schedule('a', 100)
+    scheduler.schedule('a', 500)
+
+    assert scheduler.pop_due(now=200) == []
+    assert scheduler.pop_due(now=500) == ['a']
+
+
+def test_checks_without_progress_back_off_until_max_interval():
+    scheduler = make_scheduler(max_interval=200)
+    now = to_timestamp(START) + 10000  # long after every hit was expected, so the min interval applies
+    hit_entities = [hit_entity('h0')]
+
+    intervals = [scheduler.record_check('a', hit_entities, now=now) for _ in range(5)]
+
+    assert intervals == [30, 60, 120, 200, 200]
+
+
+def test_progress_resets_the_backoff():
+    scheduler = make_scheduler()
+    now = to_timestamp(START) + 10000
+
+    scheduler.record_check('a', [hit_entity('h0', assignments_launched=2)], now=now)
+    assert scheduler.record_check('a', [hit_entity('h0', assignments_launched=2)], now=now) == 60
+
+    progressed = [hit_entity('h0', submitted_after=100, assignments_completed=1, assignments_launched=2)]
+    assert scheduler.record_check('a', progressed, now=now) == 30
+
+
+def test_outstanding_hits_are_checked_when_their_assignment_is_expected():
+    scheduler = make_scheduler()
+    now = to_timestamp(START)
+
+    # created now: the default pickup latency plus the assignment duration of the hit type
+    assert scheduler.record_check('a', [hit_entity('h0')], now=now) == 300 + 600
+
+
+def test_pickup_latency_is_learned_from_the_first_submission_time():
+    scheduler = make_scheduler()
+    now = to_timestamp(START) + 5000  # observed long after the submission, which must not count
+
+    scheduler.record_check('a', [hit_entity('h0', submitted_after=700, assignments_completed=1)], now=now)
+
+    # 700s to the first submission minus the 600s the worker had, smoothed with the default of 300s
+    assert scheduler.get_pickup_latency('video title') == pytest.approx(0.5 * 300 + 0.5 * 100)
+
+    # a hit is observed only once
+    scheduler.record_check('a', [hit_entity('h0', submitted_after=700, assignments_completed=1)], now=now)
+    assert scheduler.get_pickup_latency('video title') == pytest.approx(200)
+
+
+def test_finished_submissions_are_unscheduled():
+    scheduler = make_scheduler()
+    scheduler.schedule('a', 100)
+
+    assert scheduler.record_check('a', [], now=0) is None
+    assert scheduler.pop_due(now=1000) == []
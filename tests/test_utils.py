@@ -0,0 +1,124 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils import run_stages, CoalescingCache
+
+
+def test_run_stages_keeps_outputs_by_item_index():
+    stages = [
+        (lambda x: x + 1, 3),
+        (lambda x: x * 10, 2),
+    ]
+
+    outputs, errors = run_stages(range(20), stages, queue_size=2)
+
+    assert outputs == {i: (i + 1) * 10 for i in range(20)}
+    assert errors == {}
+
+
+def test_run_stages_reports_failed_items_and_finishes_the_others():
+    def fail_on_odd(x):
+        if x % 2 == 1:
+            raise ValueError(x)
+        return x
+
+    outputs, errors = run_stages(range(6), [(fail_on_odd, 2), (str, 1)], queue_size=1)
+
+    assert outputs == {0: '0', 2: '2', 4: '4'}
+    assert sorted(errors.keys()) == [1, 3, 5]
+    assert all(isinstance(e, ValueError) for e in errors.values())
+
+
+def test_run_stages_bounds_the_items_held_between_stages():
+    num_started = 0
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def first(x):
+        nonlocal num_started
+        with lock:
+            num_started += 1
+        return x
+
+    def blocked(x):
+        release.wait()
+        return x
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(run_stages(range(50), [(first, 1), (blocked, 1)], queue_size=2)))
+    thread.start()
+
+    time.sleep(0.2)
+    # the blocked worker holds one item and each of the two queues at most queue_size, the first worker may hold one more
+    assert num_started <= 1 + 2 + 1 + 1
+
+    release.set()
+    thread.join()
+    assert sorted(result[0][0].keys()) == list(range(50))
+
+
+def test_coalescing_cache_loads_each_key_once():
+    cache = CoalescingCache()
+    loaded = []
+
+    def load(key):
+        loaded.append(key)
+        return key * 2
+
+    assert [cache.get(key, load) for key in [1, 2, 1, 1]] == [2, 4, 2, 2]
+    assert loaded == [1, 2]
+    assert (cache.num_loads, cache.num_cache_hits) == (2, 2)
+
+    cache.invalidate(1)
+    assert cache.get(1, load) == 2
+    assert loaded == [1, 2, 1]
+
+
+def test_coalescing_cache_shares_one_load_between_concurrent_requests():
+    release = threading.Event()
+    num_calls = []
+
+    def load(key):
+        num_calls.append(key)
+        release.wait(timeout=5)
+        return 'value'
+
+    cache = CoalescingCache(ttl=0, executor=ThreadPoolExecutor(max_workers=4))
+    futures = [cache.submit('k', load) for _ in range(5)]
+    release.set()
+
+    assert [future.result() for future in futures] == ['value'] * 5
+    assert num_calls == ['k']
+
+    # ttl 0 keeps nothing once the load is done
+    assert cache.get('k', load) == 'value'
+    assert num_calls == ['k', 'k']
+
+
+def test_coalescing_cache_does_not_cache_failures():
+    cache = CoalescingCache()
+    attempts = []
+
+    def load(key):
+        attempts.append(key)
+        if len(attempts) == 1:
+            raise ValueError('flaky')
+        return 'ok'
+
+    with pytest.raises(ValueError):
+        cache.get('k', load)
+    assert cache.get('k', load) == 'ok'
+    assert cache.get('k', load) == 'ok'
+    assert len(attempts) == 2
+
+
+def test_coalescing_cache_expires_entries_after_ttl():
+    cache = CoalescingCache(ttl=0.05)
+    cache.put('k', 'primed')
+    assert cache.get('k', lambda key: 'loaded') == 'primed'
+
+    time.sleep(0.06)
+    assert cache.get('k', lambda key: 'loaded') == 'loaded'
@@ -0,0 +1,85 @@
+import collections
+import functools
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from config import THUMBNAIL_DOWNLOAD_WORKERS, THUMBNAIL_RENDER_WORKERS, THUMBNAIL_UPLOAD_WORKERS, THUMBNAIL_QUEUE_SIZE
+from image_cache import get_image_cache
+from reddit import get_submission_by_id
+from storage import upload_public_blob
+from thumbnail import get_thumbnail, FlavourImage
+from utils import run_stages
+
+ThumbnailJob = collections.namedtuple('ThumbnailJob', ['hit_id', 'submission_id', 'video_title', 'emphasis_mask', 'image_location',
+                                                       'has_solid_background', 'background_coords'])
+
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    """
+    the render processes, started once and kept for the lifetime of the process so that every render_thumbnails call reuses them
+    (and their cached submissions). they are spawned rather than forked, since the parent runs threads and an event loop by then
+    """
+    global _render_pool
+
+    with _render_pool_lock:
+        if _render_pool is None:
+            max_workers = os.cpu_count() if THUMBNAIL_RENDER_WORKERS is None else THUMBNAIL_RENDER_WORKERS
+            _render_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+        return _render_pool
+
+
+@functools.lru_cache(maxsize=None)
+def get_cached_submission(submission_id):
+    # fetched once per render process rather than pickled over from the parent
+    return get_submission_by_id(submission_id)
+
+
+def render_thumbnail_jpeg(job, image_bytes):
+    """runs in a render process, gets the downloaded flavour image and returns the encoded thumbnail"""
+    flavour_image = FlavourImage(
+        image=Image.open(io.BytesIO(image_bytes)),
+        has_solid_background=job.has_solid_background,
+        background_coords=job.background_coords,
+    )
+
+    thumbnail = get_thumbnail(get_cached_submission(job.submission_id), job.video_title, color_scheme='dark', emphasis_mask=job.emphasis_mask,
+                              flavour_image=flavour_image, language_code='en')
+
+    with io.BytesIO() as output:
+        thumbnail.save(output, format="JPEG")
+        return output.getvalue()
+
+
+def render_thumbnails(jobs, bucket, download_workers=THUMBNAIL_DOWNLOAD_WORKERS, render_workers=THUMBNAIL_RENDER_WORKERS,
+                      upload_workers=THUMBNAIL_UPLOAD_WORKERS, queue_size=THUMBNAIL_QUEUE_SIZE):
+    """
+    downloads the flavour image, renders the thumbnail and uploads it publicly to bucket for every job, as a staged pipeline.
+    returns the public urls by hit id in the order of jobs, raises the first error if any job failed
+    """
+    jobs = list(jobs)
+    render_workers = os.cpu_count() if render_workers is None else render_workers
+    render_pool = get_render_pool()
+
+    stages = [
+        (lambda job: (job, get_image_cache().get(job.image_location)), download_workers),  # mostly prefetched when the answer was accepted
+        (lambda downloaded: (downloaded[0], render_pool.submit(render_thumbnail_jpeg, *downloaded).result()), render_workers),
+        (lambda rendered: upload_public_blob(bucket, rendered[0].hit_id + '.jpg', rendered[1], content_type='image/jpeg'), upload_workers),
+    ]
+    image_urls, errors = run_stages(jobs, stages, queue_size=queue_size)
+
+    if len(errors) > 0:
+        for i, e in errors.items():
+            print(f'\t could not ready the thumbnail for {jobs[i].hit_id}: {e!r}')
+        raise errors[min(errors.keys())]
+
+    return {jobs[i].hit_id: image_urls[i] for i in sorted(image_urls.keys())}
@@ -1,6 +1,207 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
 def is_ascii_char(c):
     return ord(c) < 128
 
 
 def filter_non_ascii(s):
-    return ''.join(filter(is_ascii_char, list(s)))
\ No newline at end of file
+    if s.isascii():
+        return s
+    return s.encode('ascii', 'ignore').decode('ascii')
+
+
+def strip_non_ascii(s):
+    """returns s without its non ascii characters, along with the characters that were removed"""
+    if s.isascii():
+        return s, ''
+    return s.encode('ascii', 'ignore').decode('ascii'), ''.join(c for c in s if not is_ascii_char(c))
+
+
+def strip_non_ascii_params(params):
+    """returns a copy of params with non ascii characters removed from its string values, along with the removed characters by param name"""
+    stripped_params = dict(params)
+    stripped_characters = dict()
+
+    for k, v in params.items():
+        if not isinstance(v, str) or v.isascii():
+            continue
+
+        stripped_params[k], stripped_characters[k] = strip_non_ascii(v)
+
+    return stripped_params, stripped_characters
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def get_background_loop():
+    """one event loop, running on its own thread for the lifetime of the process, that run_sync hands its coroutines to"""
+    global _background_loop
+
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='run_sync loop', daemon=True).start()
+
+        return _background_loop
+
+
+def run_sync(coroutine):
+    """
+    runs coroutine to completion from synchronous code, which must not already be running inside an event loop.
+    all callers share the background loop rather than each starting a loop of their own
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run_coroutine_threadsafe(coroutine, get_background_loop()).result()
+
+    coroutine.close()
+    raise RuntimeError('cannot block on a coroutine inside a running event loop, await its async counterpart instead')
+
+
+def run_stages(items, stages, queue_size):
+    """
+    passes every item through the stages in order. each stage is a (function, num_workers) pair running on its own threads,
+    connected to the next by a queue of at most queue_size items, so only a bounded number of items is held at once.
+    returns the outputs of the last stage and the exceptions raised for failed items, both by item index
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    done = object()
+    num_running_workers = [num_workers for _, num_workers in stages]
+    errors = dict()
+    lock = threading.Lock()
+
+    def feed():
+        for i, item in enumerate(items):
+            queues[0].put((i, item))
+        queues[0].put(done)
+
+    def work(stage_index, function):
+        while True:
+            entry = queues[stage_index].get()
+
+            if entry is done:
+                queues[stage_index].put(done)  # for the other workers of this stage
+                with lock:
+                    num_running_workers[stage_index] -= 1
+                    last_worker = num_running_workers[stage_index] == 0
+                if last_worker:
+                    queues[stage_index + 1].put(done)
+                return
+
+            i, value = entry
+            try:
+                output = function(value)
+            except Exception as e:
+                with lock:
+                    errors[i] = e
+                continue
+
+            queues[stage_index + 1].put((i, output))
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for stage_index, (function, num_workers) in enumerate(stages):
+        threads += [threading.Thread(target=work, args=(stage_index, function), daemon=True) for _ in range(num_workers)]
+
+    for thread in threads:
+        thread.start()
+
+    outputs = dict()
+    while True:
+        entry = queues[-1].get()
+        if entry is done:
+            break
+        outputs[entry[0]] = entry[1]
+
+    for thread in threads:
+        thread.join()
+
+    return outputs, errors
+
+
+class CoalescingCache:
+    """
+    caches loaded values per key for ttl seconds (forever if ttl is None, not at all if it is 0) and coalesces concurrent loads
+    of the same key into one. loads run on executor if one is given, otherwise on the calling thread. a load that raises is not cached
+    """
+
+    def __init__(self, ttl=None, executor=None):
+        self.ttl = ttl
+        self.executor = executor
+        self.entries = dict()  # key -> (load time, value)
+        self.in_flight = dict()  # key -> future of the load currently running
+        self.lock = threading.Lock()
+
+        self.num_loads = 0
+        self.num_cache_hits = 0
+
+    def is_fresh(self, entry):
+        return self.ttl is None or time.monotonic() - entry[0] < self.ttl
+
+    def run_load(self, key, load):
+        try:
+            value = load(key)
+        except BaseException:
+            with self.lock:
+                del self.in_flight[key]
+            raise
+
+        with self.lock:
+            if self.ttl != 0:
+                self.entries[key] = (time.monotonic(), value)
+            del self.in_flight[key]
+
+        return value
+
+    def submit(self, key, load):
+        """returns a future of the value for key, calling load(key) unless it is cached or already being loaded"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.is_fresh(entry):
+                self.num_cache_hits += 1
+                future = Future()
+                future.set_result(entry[1])
+                return future
+
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.num_cache_hits += 1
+                return future
+
+            self.num_loads += 1
+            if self.executor is not None:
+                future = self.executor.submit(self.run_load, key, load)
+                self.in_flight[key] = future
+                return future
+
+            future = Future()
+            self.in_flight[key] = future
+
+        try:
+            future.set_result(self.run_load(key, load))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+    def get(self, key, load):
+        return self.submit(key, load).result()
+
+    def put(self, key, value):
+        """stores a value obtained elsewhere as if it had been loaded"""
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)